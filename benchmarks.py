@@ -0,0 +1,232 @@
+"""Benchmarks for pnr.
+
+The entry points are run as the user would, so the settings must point to
+real data.
+
+Usage:
+    benchmarks.py startup [--runs=<n>]
+    benchmarks.py backend [--runs=<n>]
+    benchmarks.py compression [--runs=<n>] [--size=<mb>]
+    benchmarks.py -h | --help
+
+Options:
+    -h --help     Show this screen.
+    --runs=<n>    Times each benchmark is run, the best one is kept
+                  [default: 5].
+    --size=<mb>   Size of the tree generated to compress [default: 64].
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from time import perf_counter
+from datetime import date
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PNR = os.path.join(HERE, 'pnr.py')
+
+# Load what a backup build loads, without building one: that would read &
+# compress the real folders & databases, swamping the startup it measures
+BACKUP = ('import pnr; pnr.Compress(quiet=True); ' +
+          'import tarfile, gzip, lzma, hashlib, subprocess, ' +
+          'concurrent.futures')
+
+
+def EntryPoints(tmp):
+    """Get the command line of each entry point.
+
+    Returns a list of (name, args) tuples, args being the arguments for the
+    python interpreter. Files are written to tmp.
+    """
+    graph = '--graph-file=' + os.path.join(tmp, 'graph.png')
+    entry_points = [('import', ['-c', 'import pnr']),
+                    ('last', [PNR, 'last', '--batch']),
+                    ('week', [PNR, 'week', '--batch']),
+                    ('year', [PNR, 'year', '--batch']),
+                    ('graph', [PNR, 'graph', '--batch', graph]),
+                    ('backup', ['-c', BACKUP]),
+                    ]
+    return entry_points
+
+
+def ParseImportTime(output):
+    """Sum the import times logged by python -X importtime.
+
+    Returns a tuple with the total time (in seconds) & a dict with the
+    cumulative time of the top level imports.
+    """
+    total, top = 0, {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit():
+            continue  # the header
+        total += int(fields[0])
+        name = fields[2]
+        if not name.startswith('  '):
+            top[name.strip()] = int(fields[1]) / 10 ** 6
+    return total / 10 ** 6, top
+
+
+def ImportTime(args):
+    """Run python with args logging the imports.
+
+    Returns a tuple with the wall time, the import time (seconds) & the top
+    level imports as ParseImportTime does.
+    """
+    start = perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            cwd=HERE, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    wall = perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError('%s failed:\n%s' % (args, result.stderr))
+    total, top = ParseImportTime(result.stderr)
+    return wall, total, top
+
+
+def Startup(runs):
+    """Print the import time of each entry point (best of runs)."""
+    tmp = tempfile.mkdtemp()
+    try:
+        print('%-8s %10s %10s  %s' % ('entry', 'imports', 'wall',
+                                      'costliest imports'))
+        for name, args in EntryPoints(tmp):
+            results = [ImportTime(args) for run in range(runs)]
+            wall, total, top = min(results, key=lambda result: result[0])
+            costliest = sorted(top, key=top.get, reverse=True)[:3]
+            costliest = ', '.join('%s %.0fms' % (module, top[module] * 1000)
+                                  for module in costliest)
+            print('%-8s %8.0fms %8.0fms  %s' % (name, total * 1000,
+                                                wall * 1000, costliest))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def Queries(db):
+    """Get the queries run by the reports on a DataYear.
+
+    Returns a list of (name, callable) tuples.
+    """
+    import pnr
+    start = date(2018, 1, 1)
+    day_list = pnr.Graph().DayList()
+    specs = [('awake', ), ('project', 19), ('tag', 'BuildUp'),
+             ('project', (26, 27, 28, 29, 30)), ('project', 31)]
+    queries = [('entries', lambda: db.LastEntriesRange(start, date.today())),
+               ('tags', lambda: db.Tags('year')),
+               ('project', lambda: db.Project('year')),
+               ('series', lambda: db.SeriesDay(start, specs, day_list)),
+               ('totals', lambda: db.DailyTotals(start)),
+               ]
+    return queries
+
+
+def Backend(runs):
+    """Print the time of the same queries on each db backend (best of runs).
+
+    Opening the db is timed too, it includes importing the backend.
+    """
+    import pnr
+    backends = sorted(pnr.DataYear.BACKENDS)
+    print('%-8s' % 'query' + ''.join('%12s' % name for name in backends))
+    timings = {}
+    for name in backends:
+        pnr.Settings.db_backend = name
+        start = perf_counter()
+        db = pnr.DataYear()
+        timings[('open', name)] = perf_counter() - start
+        for query, run in Queries(db):
+            best = None
+            for idx in range(runs):
+                start = perf_counter()
+                run()
+                elapsed = perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[(query, name)] = best
+    for query in ['open'] + [query for query, run in Queries(None)]:
+        print('%-8s' % query + ''.join('%10.1fms' % (timings[(query, name)] *
+                                                     1000)
+                                       for name in backends))
+
+
+def Tree(path, size):
+    """Generate a tree of files to compress, size in bytes.
+
+    Half of it is text (numbers, which compress well) & half random bytes
+    (like the media in the backups, which don't). Files are 1MB at most.
+    """
+    import random
+    random.seed(1)
+    os.makedirs(path)
+    written, idx = 0, 0
+    while written < size:
+        chunk = min(1024 ** 2, size - written)
+        if idx % 2:
+            data = os.urandom(chunk)
+        else:
+            text = ' '.join(str(random.randint(0, 10 ** 6))
+                            for _ in range(chunk // 6))
+            data = text.encode()[:chunk]
+        folder = os.path.join(path, 'dir%s' % (idx % 8))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'file%s' % idx), 'wb') as f:
+            f.write(data)
+        written += len(data)
+        idx += 1
+    return written
+
+
+def Compression(runs, size):
+    """Print the throughput of each compression mode (best of runs).
+
+    A tree of size MB is generated & put in a tarball by Compress.Build with
+    each format, single threaded & with a thread per cpu.
+    """
+    import pnr
+    from unittest import mock
+    tmp = tempfile.mkdtemp()
+    try:
+        total = Tree(os.path.join(tmp, 'tree'), size * 1024 ** 2)
+        cpus = os.cpu_count() or 1
+        modes = [(compression, threads) for compression in ('gz', 'xz', 'zst')
+                 for threads in sorted({1, cpus})]
+        print('%-5s %8s %10s %8s' % ('mode', 'threads', 'MB/s', 'ratio'))
+        for compression, threads in modes:
+            settings = {'home': tmp + '/', 'BACKUP_FOLDERS': ['tree'],
+                        'BACKUP_FILES': [], 'PG_BACKUPDB': False,
+                        'BACKUP_COMPRESSION': compression,
+                        'BACKUP_THREADS': threads}
+            best, ratio = None, None
+            with mock.patch.multiple(pnr.Settings, create=True, **settings):
+                for run in range(runs):
+                    compress = pnr.Compress(quiet=True)
+                    start = perf_counter()
+                    name = compress.Build()
+                    elapsed = perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                    if not name.endswith(compression):
+                        break  # zstandard is not installed
+                    ratio = os.path.getsize(os.path.join(tmp, name)) / total
+                    compress.Discard(name)
+            if ratio is None:
+                print('%-5s %8s %10s %8s' % (compression, threads, '-', '-'))
+                continue
+            print('%-5s %8s %10.1f %8.3f' % (compression, threads,
+                                             total / best / 1024 ** 2, ratio))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+    if args['startup']:
+        Startup(int(args['--runs']))
+    elif args['backend']:
+        Backend(int(args['--runs']))
+    elif args['compression']:
+        Compression(int(args['--runs']), int(args['--size']))
@@ -1,26 +1,88 @@
 """Provide useful data for final day's summary. V3
 
 Perform a backup of the files as well.
+
+Usage:
+    pnr.py [all | last | week | year | graph | backup] [options]
+    pnr.py restore <dir> [--point=<name>] [options]
+    pnr.py verify [options]
+    pnr.py -h | --help
+
+Options:
+    -h --help             Show this screen.
+    --yes                 Answer yes to every question (show the graph &
+                          backup).
+    --no-graph            Don't show the graph.
+    --graph-file=<files>  Save the graph rather than show it (.png or .svg,
+                          comma separated for several).
+    --no-backup           Don't backup.
+    --batch               Never ask, exit with an error when an answer is
+                          missing (the default when not run from a
+                          terminal).
+    --rebuild             Build the daily sums of the reports from scratch
+                          rather than only adding up the days changed.
+    --point=<name>        Tarball (or snapshot, with BACKUP_FORMAT chunks) to
+                          restore, the last one by default.
 """
-import tarfile
 import os
 import re
+import sys
+import json
+import bisect
+import calendar
 import shutil
-from zipfile import ZipFile
-import records
-from datetime import date, datetime, timedelta, time
+import sqlite3
+import tempfile
+import threading
+from collections import namedtuple, deque
+from datetime import date, datetime, timedelta, time, timezone
 from settings import Settings
-from matplotlib import pyplot as plt
-from sh import pg_dump
+from query import Select, In, RowType, RowFactory, TAG_JOINS, WINDOW, LENGHT
+from query import OVERLAP, CLIPPED, PARTS, PART, PART_LENGHT, PART_DAY
+from query import PART_WINDOW
+
+
+def Ask(question, key):
+    """Ask the user from the terminal.
+
+    Answers given beforehand (by the command line) are in Settings.answers
+    under key, those are returned right away. In batch mode (Settings.batch)
+    nothing is asked, so a missing answer exits with an error. Returns the
+    answer as a str.
+    """
+    answers = getattr(Settings, 'answers', {})
+    if key in answers:
+        return answers[key]
+    if getattr(Settings, 'batch', False):
+        sys.exit('Error: no answer for "%s" in batch mode' % question.strip())
+    return input(question)
+
+
+def OpenDb():
+    """Open the db the reports are answered from.
+
+    With Settings.db_snapshot the work log is loaded into memory at once
+    (see WorkLog), so no more queries hit the db afterwards. Returns a
+    DataYear (or WorkLog) object.
+    """
+    if getattr(Settings, 'db_snapshot', False):
+        return WorkLog()
+    return DataYear()
 
 
 class TrackDB(object):
-    """Get the last db file & unpack it into a tmp folder."""
+    """Get the last db file & unpack it into the cache folder."""
+
+    def __init__(self, day=None):
+        """Init the object.
 
-    def __init__(self):
-        """Init the object."""
+        day (a datetime.date) picks the last zip up to that day instead of the
+        latest one.
+        """
         settings = Settings()
         self.db_path = settings.db_file
+        self.day = day
+        self.index = None
 
     def GetPath(self):
         """Select te path to the db file. Try first default.
@@ -30,191 +92,513 @@ class TrackDB(object):
         default = self.db_path
         zip_dir = os.path.isdir(default)
         while zip_dir is False:
-            default = input('Couldn\'t find that location, choose manually: ')
+            default = Ask('Couldn\'t find that location, choose manually: ',
+                          'path')
             zip_dir = os.path.isdir(default)
+        self.db_path = default  # don't ask again
         return default
 
-    def GetFile(self):
+    def Index(self, refresh=False):
+        """Get the index of the zip files in the path.
+
+        The index lists (mtime, name, size, inode) tuples sorted by mtime &
+        it's stored in the cache folder along with the mtime of the path. As
+        long as the path is not modified (or refresh is given) the index is
+        reused as is, otherwise the zips are stat'ed again, since a zip may
+        have been replaced under the same name. Returns the list.
+        """
+        path = self.GetPath()
+        dir_mtime = os.stat(path).st_mtime_ns
+        if self.index is None:
+            index_file = self.CachePath() + 'index.json'
+            self.index = {'mtime': None, 'files': []}
+            if os.path.isfile(index_file):
+                with open(index_file) as f:
+                    self.index = json.load(f)
+                self.index['files'] = [tuple(f) for f in self.index['files']]
+                if any(len(f) != 4 for f in self.index['files']):
+                    self.index['mtime'] = None  # written by an older version
+
+        if refresh or self.index['mtime'] != dir_mtime:
+            files = []
+            for entry in os.scandir(path):
+                if entry.is_file() and entry.name.endswith('.zip'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name, stat.st_size,
+                                  stat.st_ino))
+            files.sort()
+            self.index = {'mtime': dir_mtime, 'files': files}
+            os.makedirs(self.CachePath(), exist_ok=True)
+            with open(self.CachePath() + 'index.json', 'w') as f:
+                json.dump(self.index, f)
+
+        return self.index['files']
+
+    def Last(self, files, day=None):
+        """Get the last entry of the index (see Index) up to a day."""
+        if day is not None:
+            end = datetime.combine(day + timedelta(days=1), time(0, 0))
+            end = datetime.timestamp(end)
+            files = files[:bisect.bisect_left(files, (end, ''))]
+        if not files:
+            raise ValueError('no zip file found in %s' % self.GetPath())
+        return files[-1]
+
+    def GetFile(self, day=None):
         """Get the last zip file from the path.
 
+        If a day (datetime.date) is given, or was given on init, get the last
+        zip file modified up to that day. The zip picked is stat'ed, if it was
+        overwritten in place (which leaves the path mtime alone) the index is
+        built again.
         Outputs a string with the name of the latest file in GetPath.
         """
-        path = self.GetPath()
-        file_namelist = []
-        file_timelist = []
-        for entry in os.scandir(path):
-            if re.search(r'.zip', entry.name):
-                file_timelist.append(entry.stat().st_mtime)
-                file_namelist.append(entry.name)
-        max_idx = file_timelist.index(max(file_timelist))
-        zipfile = file_namelist[max_idx]
+        if day is None:
+            day = self.day
+        mtime, zipfile, size, inode = self.Last(self.Index(), day)
+        try:
+            stat = os.stat(self.GetPath() + zipfile)
+            current = (stat.st_mtime, stat.st_size, stat.st_ino)
+        except FileNotFoundError:
+            current = None
+        if current != (mtime, size, inode):
+            mtime, zipfile, size, inode = self.Last(self.Index(True), day)
         return zipfile
 
+    def CachePath(self):
+        """Get the folder where the extracted dbs are kept.
+
+        Outputs a string with the path, by default a cache folder next to the
+        zip files.
+        """
+        default = self.GetPath() + 'cache/'
+        return getattr(Settings, 'db_cache_path', default)
+
+    def CacheKey(self, zipfile):
+        """Build the cache key for a zip file.
+
+        The key is made of the zip size & mtime and the CRC of its member as
+        written in the zip central directory, so nothing is extracted to get
+        it. Returns a tuple with the key & the member name.
+        """
+        from zipfile import ZipFile
+        stat = os.stat(zipfile)
+        with ZipFile(zipfile) as zip_file:
+            members = zip_file.infolist()
+        if len(members) > 1:
+            raise ValueError('more than one entry in the zip file')
+        member = members[0]
+        key = '%s-%s-%08x' % (stat.st_size, int(stat.st_mtime), member.CRC)
+        return key, member.filename
+
     def FileCheck(self):
         """Check if the zip is already extracted.
 
-        Returns a bool, true if the file is already extracted.
-        """
-        # first, check if folder exists
-        zip_path = self.GetPath()
-        tmp = zip_path + 'tmp/'
-        if os.path.isdir(tmp):
-            zipfile = self.GetPath() + self.GetFile()
-            zipfile_creation = os.stat(zipfile).st_mtime
-            folder_creation = os.stat(tmp).st_mtime
-            # Now compare creation dates
-            if folder_creation > zipfile_creation:
-                # The folder is the most recent element, so we have the last
-                # version extracted
-                exists = True
-            else:
-                # The folder is not the most recent element, so we have a
-                # newer file to extract.
-                exists = False
-        else:
-            # The folder doesn't exist, so we have to extract the file
-            exists = False
-
-        return exists
+        Returns a bool, true if the last zip is already in the cache.
+        """
+        zipfile = self.GetPath() + self.GetFile()
+        key, member = self.CacheKey(zipfile)
+        dbfile = self.CachePath() + key + '/' + member
+        return os.path.isfile(dbfile)
 
     def GetDB(self):
-        """Extract the DB into a temporally folder.
+        """Extract the DB into the cache folder.
 
-        The db (sqlite) is compressed inside a zip file, so extract from there.
+        The db (sqlite) is compressed inside a zip file, so extract from there
+        unless that very same zip was already extracted before.
         Returns a string with the file name & its full path.
         """
-        # fist, check if the file alredy exists
-        checkfile = self.FileCheck()
-        path = self.GetPath()
-        tmp_path = self.GetPath() + 'tmp/'
-        if checkfile is True:
-            files_in_path = os.listdir(tmp_path)
-            if len(files_in_path) > 1:
-                # DEBUG
-                # print(files_in_path)
-                raise ValueError('more than one file in dir')
-            dbfile = tmp_path + files_in_path[0]
+        from zipfile import ZipFile
+        zipfile = self.GetPath() + self.GetFile()
+        key, member = self.CacheKey(zipfile)
+        cache = self.CachePath()
+        entry = cache + key + '/'
+        dbfile = entry + member
+        if os.path.isfile(dbfile):
+            os.utime(entry)  # mark it as the most recently used
+            self.CacheCount('hits')
         else:
-            zipfile = path + self.GetFile()
             print('origin:', zipfile)
-            tmp = self.GetPath() + 'tmp/'
+            # extract aside & rename, so a broken run leaves no half db
+            part = cache + key + '.part/'
+            shutil.rmtree(part, ignore_errors=True)
             with ZipFile(zipfile) as zip_file:
-                members = zip_file.namelist()
-                if len(members) > 1:
-                    raise ValueError('more than one entry in the zip file')
-                zip_file.extract(members[0], path=tmp)
-                print('File found & extracted to tmp folder')
-            dbfile = tmp + members[0]
+                zip_file.extract(member, path=part)
+            os.rename(part, entry)
+            print('File found & extracted to cache folder')
+            self.CacheCount('misses')
+            self.CacheEvict(keep=key)
         return dbfile
 
+    def CacheEntries(self):
+        """List the dbs in the cache.
+
+        Returns a list of (last use, size, name) tuples, the least recently
+        used first.
+        """
+        cache = self.CachePath()
+        if not os.path.isdir(cache):
+            return []
+        result = []
+        for entry in os.scandir(cache):
+            if not entry.is_dir() or entry.name.endswith('.part'):
+                continue
+            size = 0
+            for root, dirs, files in os.walk(entry.path):
+                for name in files:
+                    size += os.path.getsize(os.path.join(root, name))
+            result.append((entry.stat().st_mtime, size, entry.name))
+        result.sort()
+        return result
+
+    def CacheEvict(self, keep):
+        """Drop the least recently used dbs until the cache fits its cap.
+
+        The entry given in keep is never dropped, even if it's bigger than the
+        cap on its own.
+        """
+        cap = getattr(Settings, 'db_cache_size', 512 * 1024 ** 2)
+        entries = self.CacheEntries()
+        total = sum(size for used, size, name in entries)
+        for used, size, name in entries:
+            if total <= cap:
+                break
+            if name != keep:
+                shutil.rmtree(self.CachePath() + name)
+                total -= size
+
+    def CacheCount(self, field):
+        """Add one to the hits or misses counter of the cache."""
+        stats_file = self.CachePath() + 'stats.json'
+        stats = self.CacheStats()
+        stats[field] += 1
+        with open(stats_file, 'w') as f:
+            json.dump(stats, f)
+
+    def CacheStats(self):
+        """Get the hits & misses stored in the cache folder."""
+        stats_file = self.CachePath() + 'stats.json'
+        stats = {'hits': 0, 'misses': 0}
+        if os.path.isfile(stats_file):
+            with open(stats_file) as f:
+                stats.update(json.load(f))
+        return stats
+
+    def CacheReport(self):
+        """Report how the cache is doing.
+
+        Returns a dict with the hits & misses so far, plus the number of
+        versions stored & their total size in bytes.
+        """
+        entries = self.CacheEntries()
+        report = self.CacheStats()
+        report['versions'] = len(entries)
+        report['size'] = sum(size for used, size, name in entries)
+        return report
+
+    def ClearCache(self):
+        """Remove all the extracted dbs & the cache stats."""
+        shutil.rmtree(self.CachePath(), ignore_errors=True)
+
+    def LoadDB(self):
+        """Load the DB straight from the zip into memory.
+
+        Nothing is written to the tmp folder, the zip member is read & handed
+        to an in-memory sqlite. Returns a sqlite3 connection.
+        """
+        from zipfile import ZipFile
+        zipfile = self.GetPath() + self.GetFile()
+        print('origin:', zipfile)
+        with ZipFile(zipfile) as zip_file:
+            members = zip_file.namelist()
+            if len(members) > 1:
+                raise ValueError('more than one entry in the zip file')
+            data = bytearray(zip_file.read(members[0]))
+
+        # A db in wal mode can't be deserialized, mark it as a legacy one
+        if data[18:20] == b'\x02\x02':
+            data[18:20] = b'\x01\x01'
+
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        if hasattr(conn, 'deserialize'):  # python >= 3.11
+            conn.deserialize(bytes(data))
+        else:
+            # No deserialize available, so copy it through the backup api
+            with tempfile.NamedTemporaryFile(suffix='.db') as f:
+                f.write(data)
+                f.flush()
+                src = sqlite3.connect(f.name)
+                src.backup(conn)
+                src.close()
+        print('File found & loaded into memory')
+        return conn
+
     def CleanUp(self):
-        """Clean de tmp dir after use. Returns a confirmation msg."""
+        """Clean de tmp dir after use. Returns a confirmation msg.
+
+        Extracted dbs live in the cache now, so this only removes the tmp
+        folder left by former versions. Use ClearCache to drop the cache.
+        """
         tmp_path = self.GetPath() + 'tmp/'
+        if not os.path.isdir(tmp_path):
+            return None
         shutil.rmtree(tmp_path)
         msg = print('Tmp folder deleted once used')
         return msg
 
 
+class SqliteBackend(object):
+    """Run the queries straight on a sqlite3 connection.
+
+    Rows are namedtuples (no instance dict, see query.RowType), the class is
+    made once per query from the cursor description.
+    """
+
+    def __init__(self, conn):
+        """Store the connection."""
+        self.conn = conn
+
+    def query(self, query, **params):
+        """Run a query binding its parameters.
+
+        Returns a list with the rows, the fields are attributes.
+        """
+        cursor = self.conn.execute(query, params)
+        if cursor.description is None:
+            return []
+        row = RowType(tuple(column[0] for column in cursor.description))
+        return list(map(row._make, cursor.fetchall()))
+
+
+class RecordsBackend(object):
+    """Run the queries through records (& SQLAlchemy), as it used to be."""
+
+    def __init__(self, conn):
+        """Wrap the connection in a records database.
+
+        The pool always hands out the very same connection, otherwise the
+        in-memory data would be lost.
+        """
+        import records
+        from sqlalchemy.pool import StaticPool
+        self.db = records.Database('sqlite://', creator=lambda: conn,
+                                   poolclass=StaticPool)
+
+    def query(self, query, **params):
+        """Run a query binding its parameters.
+
+        Returns a RecordCollection with all the rows already fetched.
+        """
+        return self.db.query(query, fetchall=True, **params)
+
+
 class DataYear(object):
     """Queries for the database."""
 
-    def __init__(self):
-        """Start the object."""
-        # Pickup the dbfile
-        tdb = TrackDB()
-        zipfile = tdb.GetDB()
-        self.db = records.Database('sqlite:///' + zipfile)
+    # Ways to run the queries, by Settings.db_backend
+    BACKENDS = {'sqlite': SqliteBackend, 'records': RecordsBackend}
 
-        # Clean the db, deleted entries return weird data
-        self.db.query("DELETE FROM work WHERE project <= 1")
+    def __init__(self, day=None):
+        """Start the object.
+
+        By default the latest zip is used, give a day (datetime.date) to use
+        the last zip up to that day. The queries are run by the backend in
+        Settings.db_backend (sqlite by default).
+        """
+        tdb = TrackDB(day)
+        self.reach = None  # see Reach
+        self.lock = threading.Lock()  # see Query
+        backend = self.BACKENDS[getattr(Settings, 'db_backend', 'sqlite')]
+        if getattr(Settings, 'db_in_memory', False):
+            # Read the db right from the zip
+            conn = tdb.LoadDB()
+            self.Prepare(conn)
+        else:
+            # Pickup the dbfile, prepare it & open it read only
+            from urllib.parse import quote
+            zipfile = tdb.GetDB()
+            conn = sqlite3.connect(zipfile)
+            self.Prepare(conn)
+            conn.close()
+            conn = sqlite3.connect('file:%s?mode=ro' % quote(zipfile),
+                                   uri=True, check_same_thread=False)
+        self.db = backend(conn)
+
+    def Prepare(self, conn):
+        """Get the db ready for the queries.
+
+        Deleted entries return weird data, so rather than deleting them (the
+        db would be rewritten on every run) the queries read from a view that
+        leaves them out. The start & stop times are stored as epoch seconds
+        too, so the lenght of the entries is a plain subtraction, and the
+        covering indexes let every time window be an index range.
+        All of them are created only if missing, so a cached db is prepared
+        just once. It's done on the raw sqlite3 connection & committed right
+        away, since the records pool rolls back whatever it gets returned &
+        the connection used for the queries is read only.
+        """
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(work)')]
+        if 'started_s' not in columns:
+            conn.executescript("""
+                ALTER TABLE work ADD COLUMN started_s INTEGER;
+                ALTER TABLE work ADD COLUMN stopped_s INTEGER;
+                UPDATE work SET
+                    started_s = CAST(strftime('%s', started) AS INTEGER),
+                    stopped_s = CAST(strftime('%s', stopped) AS INTEGER);
+                DROP VIEW IF EXISTS clean_work;
+                DROP INDEX IF EXISTS work_project_started;
+                DROP INDEX IF EXISTS work_started;
+                """)
+        conn.executescript("""
+            CREATE VIEW IF NOT EXISTS clean_work AS
+                SELECT * FROM work WHERE project > 1;
+            CREATE INDEX IF NOT EXISTS work_project_started
+                ON work (project, started, started_s, stopped_s);
+            CREATE INDEX IF NOT EXISTS work_started
+                ON work (started, project, started_s, stopped_s);
+            CREATE INDEX IF NOT EXISTS work_tag_work
+                ON work_tag (work_id, tag_id);
+            """)
+        conn.commit()
+
+    def Query(self, query, **params):
+        """Run a query built with the query module binding its parameters.
+
+        The reports may share the object from several threads (see Pipeline),
+        so queries are run one at a time & their rows fetched right away.
+        Returns the rows (a list or a RecordCollection, see BACKENDS).
+        """
+        with self.lock:
+            return self.db.query(query, **params)
+
+    def EntriesQuery(self):
+        """Get the query for the entries within a window, sorted by start."""
+        query = Select(fields=(('work.id', 'id'),
+                               ('project', 'project'),
+                               ('project_name', 'name'),
+                               ('details', 'details'),
+                               ('date(started)', 'started'),
+                               ('time(started)', 'hour'),
+                               (LENGHT, 'lenght')),
+                       where=(WINDOW, ),
+                       order='started ASC')
+        return query
 
     def LastEntriesQuery(self, day):
         """Create an object with all the data in a given day.
 
         Returns a DataFrame (df) with all the entries.
         """
-        # Fields of the query
-        fields = {'work.id': 'id',
-                  'project': 'project',
-                  'project_name': 'name',
-                  'details': 'details',
-                  'date(started)': 'started',
-                  'time(started)': 'hour',
-                  "strftime('%s',stopped)-strftime('%s', started)": 'lenght'
-                  }
-
-        # Build the field string
-        fields_str = ''
-        for k in fields:
-            r = (k + ' as \'' + fields[k] + '\', ')
-            fields_str = fields_str + r
-        fields_str = 'SELECT ' + fields_str[0:-2]
-
-        day = '\'' + str(day) + '\''
-        # day = '\'2018-01-01\''
-
-        table = ' FROM work'
-        constraint = (' WHERE date(started) = %s ' % day)
-        order = 'ORDER BY datetime(started) ASC'
-
-        # Perform the one-for-all query
-        query = fields_str + table + constraint + order
-
         # The raw query
-        df = self.db.query(query)
+        df = self.Query(self.EntriesQuery(), **self.Window(day, day))
         # to measure how many times we hit the db
         # print('db hit (last entries)')
         return df
 
-    def Period(self, period):
-        """Check if period is valid (and if not, return a valid one)."""
+    def LastEntriesRange(self, start, end):
+        """Get all the entries between two days (both included).
+
+        A single query for the whole window, then the entries are grouped by
+        day in the same pass (they come sorted). Returns a dict with the day
+        (iso str) as key & a list with its records as value, days with no
+        entries are not in the dict.
+        """
+        rows = self.Query(self.EntriesQuery(), **self.Window(start, end))
+        df = {}
+        for row in rows:
+            df.setdefault(row.started, []).append(row)
+        return df
+
+    def Start(self, period):
+        """Get the first day of a period (and default to year if not valid).
+
+        Returns a datetime.date object.
+        """
         if period == 'year':
-            period = '\'2018-01-01\''
+            start = date(2018, 1, 1)
         elif period == 'week':
             today = date.today()
             delta = timedelta(days=-1)
             start = today
             while start.isocalendar()[2] != 1:  # reduce days until reach mon
                 start = start + delta
-            period = '\'' + str(start) + '\''
         elif isinstance(period, date):
-            period = '\'' + str(period) + '\''
+            start = period
         else:
             print('Warning: period (%s) was not' % period +
                   ' understood using default(year)')
-            period = '\'2018-01-01\''
-        return period
+            start = date(2018, 1, 1)
+        return start
+
+    def Period(self, period):
+        """Check if period is valid (and if not, return a valid one).
+
+        Returns the quoted first day of the period (see Start), values are
+        bound rather than quoted in the queries though (see Window).
+        """
+        return '\'' + str(self.Start(period)) + '\''
+
+    def Reach(self):
+        """Get the lenght of the longest entry (in seconds).
+
+        No entry started longer than that before a window can overlap it.
+        It's queried just once.
+        """
+        if self.reach is None:
+            query = Select(fields=(('max(%s)' % LENGHT, 'reach'), ))
+            self.reach = self.Query(query)[0].reach or 0
+        return self.reach
+
+    def Window(self, start, end=None):
+        """Get the half-open window of time between two days.
+
+        The window goes from start at 00:00 to the day after end (today by
+        default) at 00:00, so it can be used as an index range on the raw
+        started column. Returns a dict with start & end iso strings, ready
+        to be bound to the :start & :end query parameters.
+        """
+        if end is None:
+            end = date.today()
+        end = end + timedelta(days=1)
+        return {'start': str(start), 'end': str(end)}
+
+    def Bounds(self, start, end=None):
+        """Get the window between two days to clip the entries to.
+
+        Returns the dict of Window with the epochs of both ends too (as
+        :start_s & :end_s) & the earliest start of an entry that can overlap
+        the window (as :reach, see OVERLAP).
+        """
+        if end is None:
+            end = date.today()
+        window = self.Window(start, end)
+        start_s = calendar.timegm(start.timetuple())
+        end_s = calendar.timegm((end + timedelta(days=1)).timetuple())
+        reach = datetime.fromtimestamp(max(start_s - self.Reach(), 0),
+                                       timezone.utc)
+        window.update(start_s=start_s, end_s=end_s,
+                      reach=reach.strftime('%Y-%m-%d %H:%M:%S'))
+        return window
 
     def Tags(self, period):
         """Create an object that returns sum times per tag and per period.
 
         Filter entries with python takes a long time, so we filter and sum the
         data from the query itself. Period represents the time filter (week or
-        year allowed).
+        year allowed). Entries crossing the start of the period only count
+        from there on.
         Returns a dictionary with al the values for each tag.
         """
         # first check if Period is valid
-        period = self.Period(period)
-
-        fields = {"sum(strftime('%s',stopped)-" +
-                  "strftime('%s', started))": 'lenght',
-                  'tag.name': 'tag'}
-
-        # Build the field string for the query
-        fields_str = ''
-        for k in fields:
-            r = (k + ' as \'' + fields[k] + '\', ')
-            fields_str = fields_str + r
-        fields_str = 'SELECT ' + fields_str[0:-2]
-
-        table = ' FROM work'
-        join1 = ' INNER JOIN work_tag ON work.id=work_id'
-        join2 = ' INNER JOIN tag ON tag.id=work_tag.tag_id'
-        constraint = (' WHERE date(started) >= %s ' % period)
-        sorting = 'GROUP BY tag ORDER BY work.id ASC'
-
-        query = fields_str + table + join1 + join2 + constraint + sorting
-        result = self.db.query(query)
+        window = self.Bounds(self.Start(period))
+
+        query = Select(fields=(('sum(%s)' % CLIPPED, 'lenght'),
+                               ('tag.name', 'tag')),
+                       joins=TAG_JOINS,
+                       where=(OVERLAP, ),
+                       group='tag',
+                       order='work.id ASC')
+        result = self.Query(query, **window)
         # to measure how many times we hit the db # DEBUG
         # print('Tag: db hit, %s period' % period)
 
@@ -231,26 +615,18 @@ class DataYear(object):
     def Project(self, period):
         """Query the db to get project times.
 
+        Entries crossing the start of the period only count from there on.
         Returns a dict with project:lenght pairs.
         """
         # first check if Period is valid
-        period = self.Period(period)
-
-        fields = {"sum(strftime('%s',stopped)-" +
-                  "strftime('%s', started))": 'lenght',
-                  'project_name': 'project'}
-        # Build the field string for the query
-        fields_str = ''
-        for k in fields:
-            r = (k + ' as \'' + fields[k] + '\', ')
-            fields_str = fields_str + r
-        fields_str = 'SELECT ' + fields_str[0:-2]
-        table = ' FROM work'
-        constraint = (' WHERE date(started) >= %s ' % period)
-        sorting = 'GROUP BY project ORDER BY work.id ASC'
-
-        query = fields_str + table + constraint + sorting
-        result = self.db.query(query)
+        window = self.Bounds(self.Start(period))
+
+        query = Select(fields=(('sum(%s)' % CLIPPED, 'lenght'),
+                               ('project_name', 'project')),
+                       where=(OVERLAP, ),
+                       group='project',
+                       order='work.id ASC')
+        result = self.Query(query, **window)
         # to measure how many times we hit the db # DEBUG
         # print('Project: db hit, %s period' % period)
         project_dict = {}
@@ -270,53 +646,7 @@ class DataYear(object):
         object, while project should be an integer or tuple of integers.
         If a date is not in the list, insert 0 at that position.
         """
-        # Check date
-        if not isinstance(start, date):
-            raise TypeError('Start should be a datetime.date')
-        else:
-            start = '\'' + str(start) + '\''
-
-        # Check project int
-        if not isinstance(project, int):
-            if not isinstance(project, tuple):
-                raise TypeError('Project should be a list of int or int')
-            else:
-                for i in project:
-                    if not isinstance(i, int):
-                        raise TypeError('Project should be a list of int')
-                    else:
-                        project = str(project)
-        else:
-            project = '(%s)' % project
-
-        field = ("SELECT sum(strftime('%s',stopped)-strftime('%s', started))" +
-                 " as lenght, date(started) as date")
-        table = ' FROM work'
-        constraint = (' WHERE date(started) >= %s ' % start +
-                      'AND project IN %s ' % project)
-        sorting = 'GROUP BY date(started) ORDER BY date(started) ASC'
-
-        query = field + table + constraint + sorting
-        # print('ProjectDay: db hit')
-        data = self.db.query(query)
-
-        result = []
-
-        for day in day_list:
-            date_in = False
-            for row in data:
-                if str(day) == row.date:
-                    # DEBUG
-                    # print('testing %s with %s, found!' % (day, row.date))
-                    date_in, lenght = True, row.lenght
-            if date_in:
-                result.append(lenght)
-            else:
-                result.append(0)
-                # print('date %s not found, adding 0' % day)  # DEBUG
-
-
-        return result
+        return self.SeriesDay(start, [('project', project)], day_list)[0]
 
     def TagDay(self, start, tag, day_list):
         """Get the time per tag and per day.
@@ -325,55 +655,7 @@ class DataYear(object):
         object, while tag should be an str.
         If a date is not in the list, insert 0 at that position.
         """
-        # Check date
-        if not isinstance(start, date):
-            raise TypeError('Start should be a datetime.date')
-        else:
-            start = '\'' + str(start) + '\''
-
-        # Check tag str
-        if not isinstance(tag, str):
-            raise TypeError('Tag should be an str')
-        else:
-            tag = '\'' + tag + '\''
-
-        field = ("SELECT sum(strftime('%s',stopped)-strftime('%s', started))" +
-                 " as lenght, date(started) as date")
-        table = ' FROM work'
-        join1 = ' INNER JOIN work_tag ON work.id=work_id'
-        join2 = ' INNER JOIN tag ON tag.id=work_tag.tag_id'
-        constraint = (' WHERE date(started) >= %s ' % start +
-                      'AND tag.name = %s ' % tag)
-        sorting = 'GROUP BY date(started) ORDER BY date(started) ASC'
-
-        query = field + table + join1 + join2 + constraint + sorting
-        data = self.db.query(query)
-        # print('TagDay: db hit')
-
-        result = []
-
-        for day in day_list:
-            date_in = False
-            for row in data:
-                if str(day) == row.date:
-                    # DEBUG
-                    # print('testing %s with %s, found!' % (day, row.date))
-                    date_in, lenght = True, row.lenght
-            if date_in:
-                result.append(lenght)
-            else:
-                result.append(0)
-                # print('date %s not found, adding 0' % day)  # DEBUG
-
-        if not result:
-            print('Warning: query (%s, %s) gave no result, is it written ok?'
-                  % (tag, start))
-
-        # DEBUG
-        # for row in result:
-        #     print(row)
-
-        return result
+        return self.SeriesDay(start, [('tag', tag)], day_list)[0]
 
     def AwakeDay(self, start, day_list):
         """Get the awake time per day.
@@ -382,42 +664,194 @@ class DataYear(object):
         object.
         If a date is not in the list, insert 86400 (24h) at that position.
         """
+        return self.SeriesDay(start, [('awake', )], day_list)[0]
+
+    def SeriesDay(self, start, specs, day_list):
+        """Get several per day series with a single query.
+
+        Specs is a list of tuples, each one describing a series:
+            ('project', project), project being an int or tuple of ints.
+            ('tag', tag), tag being an str.
+            ('awake', ), the awake time (see AwakeDay).
+        All of them are pivoted with CASE in the same grouped query, so the
+        work table is scanned just once. Entries are split at midnight (see
+        PARTS), so each day only gets the time within it. Returns a list with
+        one list of integers (as ProjectDay, TagDay & AwakeDay do) per spec.
+        """
         # Check date
         if not isinstance(start, date):
             raise TypeError('Start should be a datetime.date')
-        else:
-            start = '\'' + str(start) + '\''
+        window = self.Bounds(start, day_list[-1] if day_list else start)
+
+        fields = [(PART_DAY, 'date')]
+        fills = []
+        params = dict(window)
+        for idx, spec in enumerate(self.CheckSpecs(specs)):
+            name = 's%s' % idx
+            if spec[0] == 'project':
+                projects, project_params = In(name + '_', spec[1])
+                params.update(project_params)
+                case = 'project IN ' + projects
+                field = 'sum(CASE WHEN %s THEN %s END)' % (case,
+                                                           PART_LENGHT)
+                fills.append(0)
+            elif spec[0] == 'tag':
+                params[name] = spec[1]
+                tagged = Select(fields=(('work_tag.work_id', 'work_id'), ),
+                                table='work_tag',
+                                joins=TAG_JOINS[1:],
+                                where=('tag.name = :' + name, ))
+                case = 'work.id IN (%s)' % tagged
+                field = 'sum(CASE WHEN %s THEN %s END)' % (case,
+                                                           PART_LENGHT)
+                fills.append(0)
+            elif spec[0] == 'awake':
+                params[name] = 38
+                case = 'project = :' + name
+                field = '86400 - sum(CASE WHEN %s THEN %s END)' % (
+                    case, PART_LENGHT)
+                fills.append(86400)
+            fields.append((field, name))
+
+        query = Select(fields=tuple(fields),
+                       table=PART,
+                       where=(PART_WINDOW, ),
+                       group='day_s',
+                       order='day_s ASC',
+                       cte=PARTS)
+        data = list(self.Query(query, **params))
+        # print('SeriesDay: db hit')
 
-        field = ("SELECT(86400 - sum(strftime('%s',stopped)-" +
-                 "strftime('%s', started))) as lenght, date(started) as date")
-        table = ' FROM work'
-        constraint = (' WHERE date(started) >= %s ' % start +
-                      'AND project = 38 ')
-        sorting = 'GROUP BY date(started) ORDER BY date(started) ASC'
+        result = []
+        for idx, fill in enumerate(fills):
+            result.append(self.DailySeries(data, day_list, fill,
+                                           field='s%s' % idx))
+        return result
 
-        query = field + table + constraint + sorting
-        data = self.db.query(query)
-        # print('AwakeDay: db hit')
+    def MaxId(self):
+        """Get the highest id in the work table (deleted entries included)."""
+        query = Select(fields=(('max(id)', 'max_id'), ), table='work')
+        return self.Query(query)[0].max_id or 0
 
-        result = []
+    def Watermark(self, last_id, keep):
+        """Get what changed in the db since a former run.
 
-        for day in day_list:
-            date_in = False
-            for row in data:
-                if str(day) == row.date:
-                    # DEBUG
-                    # print('testing %s with %s, found!' % (day, row.date))
-                    date_in, lenght = True, row.lenght
-            if date_in:
-                result.append(lenght)
-            else:
-                result.append(86400)
-                # print('date %s not found, adding 0' % day)  # DEBUG
+        Only the entries with an id over last_id or started on keep (iso day)
+        or later are looked at. Returns a dict with the max id among them,
+        the first day with new entries (changed) & the first day that can
+        still change (keep), which is the day of the first ongoing entry or
+        otherwise the day of the last entry. Days are iso str or None.
+        """
+        query = Select(fields=(('max(work.id)', 'max_id'),
+                               ('min(CASE WHEN work.id > :last_id ' +
+                                'THEN started END)', 'changed'),
+                               ('min(CASE WHEN stopped_s IS NULL ' +
+                                'THEN started END)', 'ongoing'),
+                               ('max(started)', 'last')),
+                       where=('(started >= :keep OR work.id > :last_id)', ))
+        row = self.Query(query, last_id=last_id, keep=keep)[0]
+        mark = {'max_id': row.max_id, 'changed': None, 'keep': None}
+        if row.changed:
+            mark['changed'] = row.changed[0:10]
+        if row.last:
+            mark['keep'] = (row.ongoing or row.last)[0:10]
+        return mark
+
+    def DayChecks(self):
+        """Get a checksum of the entries started each day.
+
+        It's made of the number of entries, their ids, projects, times &
+        tags, so deleting (which sets the project to 1) or editing an old
+        entry changes the checksum of its day. Returns a dict with iso day:
+        tuple pairs.
+        """
+        tags = ('(SELECT count(*) + coalesce(sum(tag_id), 0) FROM work_tag ' +
+                'WHERE work_tag.work_id = work.id)')
+        query = Select(fields=(("date(started_s, 'unixepoch')", 'day'),
+                               ('count(*)', 'entries'),
+                               ('sum(work.id * project)', 'projects'),
+                               ('sum(work.id * (started_s + ' +
+                                'coalesce(stopped_s, 0)))', 'times'),
+                               ('sum(work.id * %s)' % tags, 'tags')),
+                       group='day')
+        return {row.day: (row.entries, row.projects, row.times, row.tags)
+                for row in self.Query(query)}
+
+    def DailyTotals(self, since):
+        """Sum the times per day & project and per day & tag since a day.
+
+        Returns a tuple with two lists, (day, project, name, seconds, entries)
+        rows & (day, tag, seconds, entries) rows. Days are iso str, entries
+        is the number of finished entries (ongoing ones have no time yet)
+        counting once per day they take up (see PARTS).
+        """
+        window = self.Bounds(since)
+        query = Select(fields=((PART_DAY, 'day'),
+                               ('project', 'project'),
+                               ('project_name', 'name'),
+                               ('coalesce(sum(%s), 0)' % PART_LENGHT,
+                                'seconds'),
+                               ('count(stop_s)', 'entries')),
+                       table=PART,
+                       where=(PART_WINDOW, ),
+                       group='day_s, project, project_name',
+                       cte=PARTS)
+        projects = [(row.day, row.project, row.name, row.seconds,
+                     row.entries) for row in self.Query(query, **window)]
+        query = Select(fields=((PART_DAY, 'day'),
+                               ('tag.name', 'tag'),
+                               ('coalesce(sum(%s), 0)' % PART_LENGHT,
+                                'seconds'),
+                               ('count(stop_s)', 'entries')),
+                       table=PART,
+                       joins=TAG_JOINS,
+                       where=(PART_WINDOW, ),
+                       group='day_s, tag.name',
+                       cte=PARTS)
+        tags = [(row.day, row.tag, row.seconds, row.entries)
+                for row in self.Query(query, **window)]
+        return projects, tags
+
+    def CheckSpecs(self, specs):
+        """Check the specs of the series given to SeriesDay.
+
+        Projects are always output as tuples of int. Raises TypeError on wrong
+        projects or tags & ValueError on unknown series. Returns a list with
+        the specs checked.
+        """
+        result = []
+        for spec in specs:
+            if spec[0] == 'project':
+                project = spec[1]
+                if isinstance(project, int):
+                    project = (project, )
+                if not isinstance(project, tuple):
+                    raise TypeError('Project should be a list of int or int')
+                if not all(isinstance(i, int) for i in project):
+                    raise TypeError('Project should be a list of int')
+                spec = ('project', project)
+            elif spec[0] == 'tag':
+                if not isinstance(spec[1], str):
+                    raise TypeError('Tag should be an str')
+            elif spec[0] != 'awake':
+                raise ValueError('series type unknown (%s)' % spec[0])
+            result.append(spec)
+        return result
 
-        # DEBUG
-        # for row in data:
-        #     print(row)
+    def DailySeries(self, data, day_list, fill=0, field='lenght'):
+        """Align the rows of a per day query with a list of days.
 
+        Data are the rows (with date & field) of a query grouped by day. They
+        are indexed by date in a single pass, so it's a lookup per day rather
+        than a scan of the rows. Days not in data (or with no value yet, like
+        ongoing entries) get fill. Returns a list of integers, one per day.
+        """
+        by_day = {}
+        for row in data:
+            value = getattr(row, field)
+            if value is not None:
+                by_day[row.date] = value
+        result = [by_day.get(str(day), fill) for day in day_list]
         return result
 
     def QualitySleep(self):
@@ -426,25 +860,643 @@ class DataYear(object):
         Quality Sleep lasts more than 7h we'll extract the ratio with the total
         sleep.
         """
-        query = ("SELECT project_name as 'project', " +
-                 "sum(strftime('%s',stopped)-strftime('%s', started)) " +
-                 "as lenght FROM work " +
-                 "WHERE date(started) >= '2018-01-01' " +
-                 "AND project = 38 " +
-                 "AND strftime('%s',stopped)-strftime('%s', started) > 25200")
-        result = self.db.query(query)
+        query = Select(fields=(('project_name', 'project'),
+                               ('sum(%s)' % LENGHT, 'lenght')),
+                       where=(WINDOW, 'project = :project',
+                              LENGHT + ' > :lenght'))
+        result = self.Query(query, project=38, lenght=25200,
+                            **self.Window(self.Start('year')))
         sleep_dict = dict()
         for row in result:
             sleep_dict[row.project] = row.lenght / 3600
         return sleep_dict
 
 
+class WorkLog(DataYear):
+    """Answer the queries from an in-memory snapshot of the work log.
+
+    The clean work log is pulled just once into columnar arrays (start &
+    stop epochs, project & a bitset of tags per entry), then every query is a
+    vectorized filter & group by over them, so no more queries hit the db.
+    The entries split at midnight are kept too (as PARTS does), sorted by
+    day, for the per day sums.
+    """
+
+    Entry = namedtuple('Entry', 'id project name details started hour lenght')
+
+    def __init__(self, day=None):
+        """Start the object & load the snapshot."""
+        super().__init__(day)
+        self.Load()
+
+    def Load(self):
+        """Pull the work log & its tags into arrays (two queries)."""
+        import numpy as np
+        query = Select(fields=(('work.id', 'id'),
+                               ('project', 'project'),
+                               ('project_name', 'name'),
+                               ('details', 'details'),
+                               ('started_s', 'started_s'),
+                               ('stopped_s', 'stopped_s')),
+                       order='started ASC')
+        rows = self.Query(query)
+
+        ids, projects, names, details, start, stop = [], [], [], [], [], []
+        name_codes = {}  # project_name: code
+        for row in rows:
+            ids.append(row.id)
+            projects.append(row.project)
+            names.append(name_codes.setdefault(row.name, len(name_codes)))
+            details.append(row.details)
+            start.append(row.started_s)
+            stop.append(row.stopped_s)
+
+        self.names = list(name_codes)  # the project name for each code
+        self.ids = np.array(ids, dtype=np.int64)
+        self.project = np.array(projects, dtype=np.int64)
+        self.name = np.array(names, dtype=np.int64)
+        self.details = details
+        self.start = np.array(start, dtype=np.int64)
+        # ongoing entries have no stop yet
+        self.done = np.array([s is not None for s in stop], dtype=bool)
+        self.stop = np.array([s or 0 for s in stop], dtype=np.int64)
+        self.lenght = np.where(self.done, self.stop - self.start, 0)
+        self.day = self.start // 86400
+
+        # Split at midnight, a part per day taken up by each entry
+        last = np.where(self.done, (self.stop - 1) // 86400, self.day)
+        count = np.maximum(last, self.day) - self.day + 1
+        part = np.repeat(np.arange(len(ids)), count)
+        offset = np.arange(len(part)) - np.repeat(np.cumsum(count) - count,
+                                                  count)
+        part_day = self.day[part] + offset
+        order = np.argsort(part_day, kind='stable')
+        self.part = part[order]  # the entry of each part
+        self.part_day = part_day[order]
+        part_start = np.maximum(self.start[self.part], self.part_day * 86400)
+        part_stop = np.minimum(self.stop[self.part],
+                               (self.part_day + 1) * 86400)
+        self.part_lenght = np.where(self.done[self.part],
+                                    part_stop - part_start, 0)
+
+        # Tags as a bitset, 64 tags per word
+        query = Select(fields=(('work_tag.work_id', 'work_id'),
+                               ('work_tag.tag_id', 'tag_id'),
+                               ('tag.name', 'tag')),
+                       table='work_tag',
+                       joins=TAG_JOINS[1:])
+        work_ids, tag_ids, codes = [], [], []
+        self.tag_codes = {}  # tag name: bit
+        for row in self.Query(query):
+            work_ids.append(row.work_id)
+            tag_ids.append(row.tag_id)
+            codes.append(self.tag_codes.setdefault(row.tag,
+                                                   len(self.tag_codes)))
+        words = max(1, (len(self.tag_codes) + 63) // 64)
+        self.tags = np.zeros((len(ids), words), dtype=np.uint64)
+        # the number of tags plus their ids per entry, see DayChecks
+        self.tag_sum = np.zeros(len(ids), dtype=np.int64)
+        if work_ids and ids:
+            work_ids = np.array(work_ids, dtype=np.int64)
+            tag_ids = np.array(tag_ids, dtype=np.int64)
+            codes = np.array(codes, dtype=np.int64)
+            order = np.argsort(self.ids)
+            pos = np.searchsorted(self.ids[order], work_ids)
+            pos = np.minimum(pos, len(ids) - 1)
+            found = self.ids[order][pos] == work_ids  # skip deleted entries
+            bits = np.left_shift(np.uint64(1),
+                                 (codes[found] % 64).astype(np.uint64))
+            np.bitwise_or.at(self.tags, (order[pos[found]],
+                                         codes[found] // 64), bits)
+            np.add.at(self.tag_sum, order[pos[found]], 1 + tag_ids[found])
+
+    def HasTag(self, tag):
+        """Get a bool array telling which entries have the tag."""
+        import numpy as np
+        code = self.tag_codes.get(tag)
+        if code is None:
+            return np.zeros(len(self.ids), dtype=bool)
+        word = self.tags[:, code // 64]
+        return (word >> np.uint64(code % 64)) & np.uint64(1) == 1
+
+    def Epoch(self, day):
+        """Get the epoch seconds of a day at 00:00 (as sqlite's strftime)."""
+        return calendar.timegm(day.timetuple())
+
+    def Span(self, start, end):
+        """Get the slice of entries started between two days (both included).
+
+        Entries are sorted by start, so it's a binary search on each end.
+        Returns a slice object.
+        """
+        import numpy as np
+        low = self.Epoch(start)
+        high = self.Epoch(end + timedelta(days=1))
+        return slice(np.searchsorted(self.start, low),
+                     np.searchsorted(self.start, high))
+
+    def Parts(self, start, end):
+        """Get the slice of parts within two days (both included)."""
+        import numpy as np
+        low = self.Epoch(start) // 86400
+        high = self.Epoch(end) // 86400 + 1
+        return slice(np.searchsorted(self.part_day, low),
+                     np.searchsorted(self.part_day, high))
+
+    def Overlap(self, period):
+        """Get the entries overlapping a period & their lenght within it.
+
+        Returns a tuple with a bool array & an array with the lenghts, as
+        OVERLAP & CLIPPED do.
+        """
+        import numpy as np
+        low = self.Epoch(self.Start(period))
+        high = self.Epoch(date.today() + timedelta(days=1))
+        mask = ((self.start < high) &
+                ((self.done & (self.stop > low)) | (self.start >= low)))
+        clipped = (np.minimum(self.stop, high) - np.maximum(self.start, low))
+        lenght = np.where(self.done, clipped, 0)
+        return mask, lenght
+
+    def Entries(self, span):
+        """Build the entries (as LastEntriesQuery rows) in a span."""
+        result = []
+        for idx in range(len(self.ids))[span]:
+            started = datetime.fromtimestamp(self.start[idx], timezone.utc)
+            lenght = int(self.lenght[idx]) if self.done[idx] else None
+            name = self.names[self.name[idx]]
+            entry = self.Entry(int(self.ids[idx]), int(self.project[idx]),
+                               name, self.details[idx],
+                               started.strftime('%Y-%m-%d'),
+                               started.strftime('%H:%M:%S'), lenght)
+            result.append(entry)
+        return result
+
+    def LastEntriesQuery(self, day):
+        """Get all the entries in a given day as a list."""
+        return self.Entries(self.Span(day, day))
+
+    def LastEntriesRange(self, start, end):
+        """Get all the entries between two days grouped by day.
+
+        Returns a dict as DataYear.LastEntriesRange does.
+        """
+        df = {}
+        for entry in self.Entries(self.Span(start, end)):
+            df.setdefault(entry.started, []).append(entry)
+        return df
+
+    def Reach(self):
+        """Get the lenght of the longest entry, see DataYear's."""
+        return int(self.lenght.max()) if len(self.lenght) else 0
+
+    def Tags(self, period):
+        """Get the sum times per tag for the period (in hours)."""
+        mask, lenght = self.Overlap(period)
+        tag_dict = {}
+        for tag in self.tag_codes:
+            has = self.HasTag(tag) & mask
+            if has.any():
+                tag_dict[tag] = float(lenght[has].sum()) / 3600
+        return tag_dict
+
+    def Project(self, period):
+        """Get the sum times per project for the period (in hours)."""
+        import numpy as np
+        mask, lenght = self.Overlap(period)
+        name = self.name[mask]
+        sums = np.bincount(name, weights=lenght[mask],
+                           minlength=len(self.names))
+        count = np.bincount(name, minlength=len(self.names))
+        project_dict = {}
+        for code in np.flatnonzero(count):
+            project_dict[self.names[code]] = float(sums[code]) / 3600
+        return project_dict
+
+    def QualitySleep(self):
+        """Get the sleep quantity (more than 7h), see DataYear's."""
+        span = self.Span(self.Start('year'), date.today())
+        quality = ((self.project[span] == 38) & self.done[span] &
+                   (self.lenght[span] > 25200))
+        sleep_dict = dict()
+        if quality.any():
+            name = self.names[self.name[span][quality][0]]
+            sleep_dict[name] = float(self.lenght[span][quality].sum()) / 3600
+        return sleep_dict
+
+    def SeriesDay(self, start, specs, day_list):
+        """Get several per day series, see DataYear's.
+
+        Each series is a masked bincount over the days of the parts.
+        """
+        import numpy as np
+        # Check date
+        if not isinstance(start, date):
+            raise TypeError('Start should be a datetime.date')
+        specs = self.CheckSpecs(specs)
+        end = day_list[-1] if day_list else start
+        span = self.Parts(start, end)
+        entry = self.part[span]
+        days = (end - start).days + 1
+        idx = self.part_day[span] - self.Epoch(start) // 86400
+        lenght = self.part_lenght[span]
+        done = self.done[entry]
+        pos = np.array([(day - start).days for day in day_list],
+                       dtype=np.int64)
+        inside = (pos >= 0) & (pos < days)
+        pos = np.where(inside, pos, 0)
+
+        result = []
+        for spec in specs:
+            if spec[0] == 'project':
+                mask = np.isin(self.project[entry], spec[1])
+            elif spec[0] == 'tag':
+                mask = self.HasTag(spec[1])[entry]
+            else:
+                mask = self.project[entry] == 38
+            mask = mask & done
+            sums = np.bincount(idx[mask], weights=lenght[mask],
+                               minlength=days)
+            count = np.bincount(idx[mask], minlength=days)
+            if spec[0] == 'awake':
+                values, fill = 86400 - sums, 86400
+            else:
+                values, fill = sums, 0
+            series = np.where(inside & (count[pos] > 0), values[pos], fill)
+            result.append(series.astype(np.int64).tolist())
+        return result
+
+    def Day(self, epoch):
+        """Get the iso day of an epoch."""
+        return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d')
+
+    def MaxId(self):
+        """Get the highest id in the snapshot."""
+        return int(self.ids.max()) if len(self.ids) else 0
+
+    def Watermark(self, last_id, keep):
+        """Get what changed in the db since a former run, see DataYear's."""
+        keep = datetime.strptime(keep, '%Y-%m-%d').date()
+        new = self.ids > last_id
+        recent = new | (self.start >= self.Epoch(keep))
+        mark = {'max_id': None, 'changed': None, 'keep': None}
+        if recent.any():
+            mark['max_id'] = int(self.ids[recent].max())
+            ongoing = recent & ~self.done
+            if ongoing.any():
+                mark['keep'] = self.Day(self.start[ongoing].min())
+            else:
+                mark['keep'] = self.Day(self.start[recent].max())
+        if new.any():
+            mark['changed'] = self.Day(self.start[new].min())
+        return mark
+
+    def DayChecks(self):
+        """Get a checksum of the entries started each day, see DataYear's.
+
+        The sums are made with add.at over int64, so they're exact.
+        """
+        import numpy as np
+        days, inverse = np.unique(self.day, return_inverse=True)
+        values = np.stack([np.ones(len(self.ids), dtype=np.int64),
+                           self.ids * self.project,
+                           self.ids * (self.start +
+                                       np.where(self.done, self.stop, 0)),
+                           self.ids * self.tag_sum], axis=1)
+        sums = np.zeros((len(days), 4), dtype=np.int64)
+        np.add.at(sums, inverse.ravel(), values)
+        return {self.Day(day * 86400): tuple(int(v) for v in sums[idx])
+                for idx, day in enumerate(days)}
+
+    def DailyTotals(self, since):
+        """Sum the times per day & project and per day & tag since a day.
+
+        See DataYear's, here the groups are made with unique & bincount.
+        """
+        import numpy as np
+        span = self.Parts(since, date.today())
+        entry = self.part[span]
+        day = self.part_day[span]
+        lenght = self.part_lenght[span]
+        done = self.done[entry]
+
+        keys = np.stack([day, self.project[entry], self.name[entry]], axis=1)
+        projects = []
+        if len(keys):
+            groups, inverse = np.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            seconds = np.bincount(inverse, weights=lenght)
+            entries = np.bincount(inverse, weights=done)
+            for idx, (d, project, name) in enumerate(groups):
+                projects.append((self.Day(d * 86400), int(project),
+                                 self.names[name], int(seconds[idx]),
+                                 int(entries[idx])))
+
+        tags = []
+        first = day.min() if len(day) else 0
+        for tag in self.tag_codes:
+            has = self.HasTag(tag)[entry]
+            idx = day[has] - first
+            count = np.bincount(idx)
+            seconds = np.bincount(idx, weights=lenght[has])
+            entries = np.bincount(idx, weights=done[has])
+            for d in np.flatnonzero(count):
+                tags.append((self.Day((first + d) * 86400), tag,
+                             int(seconds[d]), int(entries[d])))
+        return projects, tags
+
+
+class Rollup(object):
+    """Keep the times per day in a db of its own & answer from there.
+
+    Sums per (day, project) & per (day, tag) are stored outside the tracker
+    db, so each run only aggregates the days with new (or ongoing) entries
+    since the former one, or whose entries were deleted or edited (see
+    DayChecks). Their prefix sums answer the totals of any period
+    in constant time. Queries that can't be answered from the daily sums
+    (like QualitySleep) are passed on to the db.
+    """
+
+    # Bump it when the way the sums are made changes, so older rollups are
+    # built again (2: entries split at midnight, 3: days checked)
+    version = 3
+
+    def __init__(self, db, path=None):
+        """Open (or create) the rollup db.
+
+        db is the DataYear (or WorkLog) to take the entries from. By default
+        the rollup is kept in the cache folder.
+        """
+        self.db = db
+        if path is None:
+            default = TrackDB().CachePath() + 'rollup.db'
+            path = getattr(Settings, 'rollup_file', default)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = RowFactory
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS project_day (
+                day TEXT, project INTEGER, name TEXT, seconds INTEGER,
+                entries INTEGER, PRIMARY KEY (day, project, name));
+            CREATE TABLE IF NOT EXISTS tag_day (
+                day TEXT, tag TEXT, seconds INTEGER, entries INTEGER,
+                PRIMARY KEY (day, tag));
+            CREATE TABLE IF NOT EXISTS day_check (
+                day TEXT PRIMARY KEY, entries INTEGER, projects INTEGER,
+                times INTEGER, tags INTEGER);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+            """)
+        self.prefix = {}  # prefix sums per table, see Totals
+        self.lock = threading.RLock()  # see Execute
+
+    def __getattr__(self, name):
+        """Pass on to the db whatever is not answered by the rollup."""
+        if name in ('db', 'lock'):
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def Execute(self, query, params=()):
+        """Run a query on the rollup db.
+
+        The connection is shared by the reports (see Pipeline), so queries
+        are run one at a time. Returns a list with the rows.
+        """
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def Meta(self):
+        """Get the watermark of the former run as a dict."""
+        rows = self.Execute('SELECT key, value FROM meta')
+        return {row.key: row.value for row in rows}
+
+    def Update(self):
+        """Bring the rollup up to date with the db.
+
+        The days from the first one that could change since the former run
+        (that with an ongoing or the last entry), from the first one with
+        new entries or from the first one whose checksum is not the one seen
+        before (entries deleted or edited, see DataYear.DayChecks) are
+        dropped & aggregated again. If the db has lower ids than those seen
+        before, it's another db, so it's built from scratch (as it is if the
+        rollup was made by another version).
+        Returns the first day updated as an iso str.
+        """
+        meta = self.Meta()
+        last_id = meta.get('last_id', -1)
+        keep = meta.get('keep', str(date.min))
+        if (self.db.MaxId() < last_id or
+                meta.get('version') != self.version):
+            last_id, keep = -1, str(date.min)
+
+        mark = self.db.Watermark(last_id, keep)
+        since = keep
+        if mark['changed'] is not None:
+            since = min(since, mark['changed'])
+        checks = self.db.DayChecks()
+        seen = {row.day: tuple(row[1:])
+                for row in self.Execute('SELECT * FROM day_check')}
+        changed = [day for day in set(checks) | set(seen)
+                   if checks.get(day) != seen.get(day)]
+        if changed:
+            since = min([since] + changed)
+        projects, tags = self.db.DailyTotals(
+            datetime.strptime(since, '%Y-%m-%d').date())
+
+        with self.conn:
+            self.conn.execute('DELETE FROM project_day WHERE day >= ?',
+                              (since, ))
+            self.conn.execute('DELETE FROM tag_day WHERE day >= ?', (since, ))
+            self.conn.executemany('INSERT INTO project_day ' +
+                                  'VALUES (?, ?, ?, ?, ?)', projects)
+            self.conn.executemany('INSERT INTO tag_day VALUES (?, ?, ?, ?)',
+                                  tags)
+            if mark['max_id'] is not None:
+                last_id = max(last_id, mark['max_id'])
+            if mark['keep'] is not None:
+                keep = mark['keep']
+            self.conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                  (('last_id', last_id), ('keep', keep),
+                                   ('version', self.version)))
+            self.conn.execute('DELETE FROM day_check')
+            self.conn.executemany('INSERT INTO day_check ' +
+                                  'VALUES (?, ?, ?, ?, ?)',
+                                  [(day, ) + checks[day] for day in checks])
+        self.prefix = {}  # the sums changed, build them again on next use
+        return since
+
+    def Rebuild(self):
+        """Drop all the sums & build the rollup from scratch."""
+        with self.conn:
+            self.conn.execute('DELETE FROM project_day')
+            self.conn.execute('DELETE FROM tag_day')
+            self.conn.execute('DELETE FROM day_check')
+            self.conn.execute('DELETE FROM meta')
+        return self.Update()
+
+    def Refresh(self):
+        """Update the rollup, or Rebuild it if asked to (--rebuild).
+
+        Returns the first day updated as an iso str.
+        """
+        if getattr(Settings, 'rebuild', False):
+            return self.Rebuild()
+        return self.Update()
+
+    def Prefix(self, table, key):
+        """Build the cumulative seconds per key (project name or tag) & day.
+
+        Returns a dict with the first day (as ordinal), the keys & two arrays
+        (a row per key & a column per day, plus a leading 0 column) with the
+        seconds & the number of rows up to each day. So the totals of any
+        window are just the difference between two columns.
+        """
+        import numpy as np
+        query = Select(fields=(('day', 'day'), (key, 'key'),
+                               ('sum(seconds)', 'seconds'),
+                               ('count(*)', 'rows')),
+                       table=table,
+                       group='day, ' + key)
+        rows = self.Execute(query)
+        days = [datetime.strptime(row.day, '%Y-%m-%d').toordinal()
+                for row in rows]
+        first = min(days) if days else date.today().toordinal()
+        codes = {}
+        keys = [codes.setdefault(row.key, len(codes)) for row in rows]
+        last = max(days + [date.today().toordinal()])
+        width = last - first + 2
+        seconds = np.zeros((len(codes), width), dtype=np.int64)
+        count = np.zeros((len(codes), width), dtype=np.int64)
+        if rows:
+            columns = np.array(days) - first + 1
+            np.add.at(seconds, (keys, columns),
+                      [row.seconds for row in rows])
+            np.add.at(count, (keys, columns), [row.rows for row in rows])
+        prefix = {'first': first, 'keys': list(codes),
+                  'seconds': np.cumsum(seconds, axis=1),
+                  'rows': np.cumsum(count, axis=1)}
+        return prefix
+
+    def Totals(self, table, start, end=None):
+        """Get the seconds per key between two days (both included).
+
+        The prefix sums are built on first use (and after every Update), then
+        it's a constant time difference per key, no query involved. Returns
+        a dict with key:seconds pairs for the keys with entries in the window.
+        """
+        import numpy as np
+        with self.lock:
+            if table not in self.prefix:
+                key = 'tag' if table == 'tag_day' else 'name'
+                self.prefix[table] = self.Prefix(table, key)
+            prefix = self.prefix[table]
+        if end is None:
+            end = date.today()
+        width = prefix['seconds'].shape[1]
+        low = min(max(start.toordinal() - prefix['first'], 0), width - 1)
+        high = min(max(end.toordinal() - prefix['first'] + 1, 0), width - 1)
+        seconds = prefix['seconds'][:, high] - prefix['seconds'][:, low]
+        rows = prefix['rows'][:, high] - prefix['rows'][:, low]
+        totals = {}
+        for idx in np.flatnonzero(rows):
+            totals[prefix['keys'][idx]] = int(seconds[idx])
+        return totals
+
+    def Tags(self, period):
+        """Get the sum times per tag for the period (in hours)."""
+        totals = self.Totals('tag_day', self.db.Start(period))
+        tag_dict = {tag: totals[tag] / 3600 for tag in totals}
+        return tag_dict
+
+    def Project(self, period):
+        """Get the sum times per project for the period (in hours)."""
+        totals = self.Totals('project_day', self.db.Start(period))
+        project_dict = {name: totals[name] / 3600 for name in totals}
+        return project_dict
+
+    def SeriesDay(self, start, specs, day_list):
+        """Get several per day series from the daily sums, see DataYear's.
+
+        The sums of both tables within the window are put together & all the
+        series are pivoted with CASE in the same grouped query, as DataYear
+        does, so it's a single query whatever the number of specs.
+        """
+        if not isinstance(start, date):
+            raise TypeError('Start should be a datetime.date')
+        params = self.db.Window(start, day_list[-1] if day_list else start)
+        fields = [('day', 'date')]
+        fills = []
+        kinds = set()
+        for idx, spec in enumerate(self.db.CheckSpecs(specs)):
+            name = 's%s' % idx
+            if spec[0] == 'tag':
+                params[name] = spec[1]
+                case = "kind = 'tag' AND key = :" + name
+            else:
+                projects = spec[1] if spec[0] == 'project' else (38, )
+                projects, project_params = In(name + '_', projects)
+                params.update(project_params)
+                case = "kind = 'project' AND key IN " + projects
+            kinds.add('tag' if spec[0] == 'tag' else 'project')
+            seconds = 'sum(CASE WHEN %s THEN seconds END)' % case
+            if spec[0] == 'awake':
+                seconds = '86400 - ' + seconds
+                fills.append(86400)
+            else:
+                fills.append(0)
+            field = ('CASE WHEN sum(CASE WHEN %s THEN entries END) > 0 ' +
+                     'THEN %s END') % (case, seconds)
+            fields.append((field, name))
+        if not fills:
+            return []
+
+        # (day, kind, key, seconds, entries) rows of the tables needed
+        daily = []
+        for kind, table, key in (('project', 'project_day', 'project'),
+                                 ('tag', 'tag_day', 'tag')):
+            if kind in kinds:
+                daily.append(Select(fields=(('day', 'day'),
+                                            ("'%s'" % kind, 'kind'),
+                                            (key, 'key'),
+                                            ('seconds', 'seconds'),
+                                            ('entries', 'entries')),
+                                    table=table,
+                                    where=('day >= :start AND day < :end', )))
+        query = Select(fields=tuple(fields),
+                       table='(%s) AS daily' % ' UNION ALL '.join(daily),
+                       group='day',
+                       order='day ASC')
+        data = self.Execute(query, params)
+        result = []
+        for idx, fill in enumerate(fills):
+            result.append(self.db.DailySeries(data, day_list, fill,
+                                              field='s%s' % idx))
+        return result
+
+    def ProjectDay(self, start, project, day_list):
+        """Get the time per project and per day, see DataYear's."""
+        return self.SeriesDay(start, [('project', project)], day_list)[0]
+
+    def TagDay(self, start, tag, day_list):
+        """Get the time per tag and per day, see DataYear's."""
+        return self.SeriesDay(start, [('tag', tag)], day_list)[0]
+
+    def AwakeDay(self, start, day_list):
+        """Get the awake time per day, see DataYear's."""
+        return self.SeriesDay(start, [('awake', )], day_list)[0]
+
+
 class LastEntries(object):
     """Print last entries for the daily summary."""
 
-    def __init__(self):
-        """Customize the object."""
+    def __init__(self, db=None):
+        """Customize the object.
+
+        db is the shared DataYear session, if none is given a new one is
+        opened when the data is first needed (see OpenDb).
+        """
         self.days = Settings.last_entries_days
+        self.db = db
+        self.df = None  # see Fetch
 
     def DateList(self):
         """Create a list with the dates to be shown.
@@ -468,18 +1520,25 @@ class LastEntries(object):
         """Create a list with the data to be shown.
 
         Returns a list that contains n lists (one per day) each one with a
-        records.Record, since filters always output a list.
+        records.Record, since filters always output a list. All the days are
+        fetched in a single query.
         """
-        db = DataYear()
-        last_entries = db.LastEntriesQuery
+        if self.db is None:
+            self.db = OpenDb()
         date_list = self.DateList()
-        df = []
+        if not date_list:
+            return []
+        entries = self.db.LastEntriesRange(date_list[0], date_list[-1])
+        df = [entries.get(str(day), []) for day in date_list]
+        return df
 
-        for i in date_list:
-            data_filtered = last_entries(i)
-            df.append(data_filtered)
+    def Fetch(self):
+        """Get the data ready, so Output just prints it.
 
-        return df
+        Returns the object itself (see Pipeline).
+        """
+        self.df = self.DataFrame()
+        return self
 
     def Output(self):
         """Output the result.
@@ -487,12 +1546,11 @@ class LastEntries(object):
         Take each one of the days in the df and print the entries. The input is
         list with n lists (one per day) each one with a records.Record.
         """
-        df = self.DataFrame()
-        day = 0
-        for entry in df:
+        if self.df is None:
+            self.Fetch()
+        for day, entry in zip(self.DateList(), self.df):
             print(50 * '*')
-            print(self.DateList()[day])
-            day += 1
+            print(day)
             for row in entry:
                 hour = row.hour[0:5]
                 if not row.lenght:
@@ -514,8 +1572,9 @@ class LastEntries(object):
 
 
 class Week(object):
-    def __init__(self):
-        db = DataYear()
+    def __init__(self, db=None):
+        if db is None:
+            db = DataYear()
         self.tag_times = db.Tags(period='week')
         self.project_times = db.Project(period='week')
 
@@ -631,8 +1690,9 @@ class Week(object):
 class Year(object):
     """Refactor current year by filtering right from the db."""
 
-    def __init__(self):
-        db = DataYear()
+    def __init__(self, db=None):
+        if db is None:
+            db = DataYear()
         self.tag_times = db.Tags(period='year')
         self.project_times = db.Project(period='year')
         self.tag = db.Tags
@@ -755,39 +1815,74 @@ class Year(object):
 class Graph(object):
     """Show powerful graphs to visualize the year progress."""
 
+    # The figure template, a subplot per row with the data (index in the
+    # plotted tuple), the y label, the goal line (if any) & the color
+    SUBPLOTS = ((0, '% over goal', 100, 'teal'),  # math
+                (3, '% over time tracked', 20, 'darkturquoise'),  # buildup
+                (1, '% over time tracked', None, 'limegreen'),  # opk
+                (2, '% over time tracked', None, 'mediumseagreen'),  # shared
+                )
+
+    def __init__(self, db=None):
+        """Store the shared DataYear session (opened on demand if none)."""
+        self.db = db
+        self.to_plot = None  # see Fetch
+        self.figure = None  # see Render
+
     def Output(self):
-        """Customize the object."""
-        db = DataYear()
+        """Customize the object.
+
+        With Settings.graph_files the graph is saved to those files rather
+        than shown.
+        """
+        if self.to_plot is None:
+            self.Fetch()
+        files = getattr(Settings, 'graph_files', [])
+        if files:
+            for name in self.Render(self.to_plot, files):
+                print('Graph saved to', name)
+        elif Ask('Press g to show graph: ', 'graph') == 'g':
+            self.PlotIt(self.to_plot)
+
+    def Fetch(self):
+        """Get the data ready to plot.
+
+        Returns the object itself (see Pipeline).
+        """
+        if self.db is None:
+            self.db = DataYear()
+        db = self.db
         start = Settings.start_graph
         day_list = self.DayList()
 
-        awake_data = db.AwakeDay(start, day_list)
+        # All the series come from a single query
+        math_project = (19)
+        bu_tag = 'BuildUp'
+        opk_projects = (26, 27, 28, 29, 30)
+        shared_projects = (31)
+        specs = [('awake', ),
+                 ('project', math_project),
+                 ('tag', bu_tag),
+                 ('project', opk_projects),
+                 ('project', shared_projects),
+                 ]
+        series = db.SeriesDay(start, specs, day_list)
+        awake_data, math_data, bu_tag_data, opk_data, shared_data = series
 
         # Math goal progress
-        math_project = (19)
-        math_data = db.ProjectDay(start, math_project, day_list)
         goal_data = [(400*3600/(365)) for value in math_data]
         math = self.PrepareData(math_data, goal_data, 'Math Progress')
 
         # BuildUp total data
-        bu_tag = 'BuildUp'
-        bu_tag_data = db.TagDay(start, bu_tag, day_list)
         bu_total = self.PrepareData(bu_tag_data, awake_data, 'BildUp total')
 
         # Opk data
-        opk_projects = (26, 27, 28, 29, 30)
-        opk_data = db.ProjectDay(start, opk_projects, day_list)
         opk = self.PrepareData(opk_data, awake_data, 'Opk')
 
-        shared_projects = (31)
-        shared_data = db.ProjectDay(start, shared_projects, day_list)
         shared = self.PrepareData(shared_data, awake_data, 'Shared')
 
-        to_plot = (math, opk, shared, bu_total)
-
-        TrackDB().CleanUp()  # & Clean the tmp folder.
-        if input('Press g to show graph: ') == 'g':
-            self.PlotIt(to_plot)
+        self.to_plot = (math, opk, shared, bu_total)
+        return self
 
     def DayList(self):
         """Create a list with all the dates since 20-01-2018.
@@ -805,36 +1900,39 @@ class Graph(object):
         return result
 
     def Aggregation(self, values):
-        """Get the acumulated hours per day. Outputs a list of floats."""
-        if not isinstance(values, list):
+        """Get the acumulated hours per day. Outputs an array of floats."""
+        import numpy as np
+        if not isinstance(values, (list, np.ndarray)):
             print(type(values))
             raise TypeError('Aggregation values should be in a list')
 
-        idx = 1
-        result = []
-        for i in values:
-            r = sum(values[0:idx])
-            result.append(r)
-            idx += 1
+        result = np.cumsum(np.asarray(values, dtype=float))
         # print(result)
         return result
 
     def Ratio(self, over, under):
-        """Get the ratio between Buildup & awake time per day."""
+        """Get the ratio between Buildup & awake time per day.
+
+        Days where under is 0 have no ratio, so they get nan (the plot just
+        leaves them out). Outputs an array of floats.
+        """
+        import numpy as np
+        over = np.asarray(over, dtype=float)
+        under = np.asarray(under, dtype=float)
         if len(over) != len(under):
             print(len(over), len(under))
             raise ValueError('awake & aggregated don\'t match')
-        result = []
-        for k in over:
-            idx = over.index(k)
-            # print(idx)
-            r = k * 100 / under[idx]
-            result.append(r)
+        result = np.full(len(over), np.nan)
+        np.divide(over * 100, under, out=result, where=under != 0)
 
         return result
 
     def PrepareData(self, data, awake_data, label):
-        """Arraange all the data so Plot it can understand."""
+        """Arraange all the data so Plot it can understand.
+
+        The cumulative sums & the ratio are computed over numpy arrays, so
+        it's linear in the number of days.
+        """
         agg = self.Aggregation(data)
         awake_agg = self.Aggregation(awake_data)
         ratio = self.Ratio(agg[:-1], awake_agg[:-1])
@@ -846,165 +1944,1232 @@ class Graph(object):
         """Output the plot.
 
         Transforms every item in data (list of floats) into a line in the plot
-        and adds the label.
+        and adds the label. Matplotlib is only imported here, so runs without
+        graph don't pay for it.
         """
-        xvalues = [day for day in range(0, len(data[0]['data']))]  # x-axis val
-        last = -(len(xvalues) - 20)  # first days are quite irregular
-        grid_color = 'silver'
-
-        plt.figure(1)
-
-        # math
-        row = data[0]
-        values = row['data']
-        label = row['label']
-        plt.subplot(411)
-        plt.ylabel('% over goal')
-        plt.grid(color=grid_color, linestyle='-', linewidth='0.5')
-        plt.axhline(y=100, linewidth='2')
-        plt.plot(xvalues[last:], values[last:], label=label, color='teal')
-        plt.legend()
-
-        # Buildup
-        row = data[3]
-        values = row['data']
-        label = row['label']
-        plt.subplot(412)
-        plt.ylabel('% over time tracked')
-        plt.grid(color=grid_color, linestyle='-', linewidth='0.5')
-        plt.axhline(y=20, linewidth='2')
-        plt.plot(xvalues[last:], values[last:], label=label,
-                 color='darkturquoise')
-        plt.legend()
-
-        # Opk
-        row = data[1]
-        values = row['data']
-        label = row['label']
-        plt.subplot(413)
-        plt.ylabel('% over time tracked')
-        plt.grid(color=grid_color, linestyle='-', linewidth='0.5')
-        plt.plot(xvalues[last:], values[last:], label=label, color='limegreen')
-        plt.legend()
-
-        # Shared
-        row = data[2]
-        values = row['data']
-        label = row['label']
-        plt.subplot(414)
-        plt.ylabel('% over time tracked')
-        plt.grid(color=grid_color, linestyle='-', linewidth='0.5')
-        plt.plot(xvalues[last:], values[last:], label=label,
-                 color='mediumseagreen')
-        plt.legend()
+        from matplotlib import pyplot as plt
+        lines = self.Template(plt.figure(1))
+        self.Draw(lines, data)
 
         # Finally, show the graph
         plt.show()
 
+    def Render(self, data, files):
+        """Save the plot to files (the format is taken from the extension).
+
+        It's drawn with the Agg backend, so no display is needed. The figure
+        is laid out once & reused by the later renders, only the lines are
+        updated. Returns the list of files.
+        """
+        if self.figure is None:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.figure = Figure(figsize=(8, 10))
+            FigureCanvasAgg(self.figure)
+            self.lines = self.Template(self.figure)
+        self.Draw(self.lines, data)
+        for name in files:
+            self.figure.savefig(name)
+        return files
+
+    def Template(self, figure):
+        """Lay the subplots out on a figure (see SUBPLOTS).
+
+        Returns a list with the (empty) line of each subplot.
+        """
+        grid_color = 'silver'
+        lines = []
+        for idx, (_, ylabel, goal, color) in enumerate(self.SUBPLOTS):
+            axes = figure.add_subplot(len(self.SUBPLOTS), 1, idx + 1)
+            axes.set_ylabel(ylabel)
+            axes.grid(color=grid_color, linestyle='-', linewidth=0.5)
+            if goal is not None:
+                axes.axhline(y=goal, linewidth=2)
+            line, = axes.plot([], [], color=color)
+            lines.append(line)
+        return lines
+
+    def Draw(self, lines, data):
+        """Put the data on the lines of a template."""
+        import numpy as np
+        xvalues = np.arange(len(data[0]['data']))  # x-axis val
+        last = -(len(xvalues) - 20)  # first days are quite irregular
+        for line, spec in zip(lines, self.SUBPLOTS):
+            row = data[spec[0]]
+            line.set_data(xvalues[last:], row['data'][last:])
+            line.set_label(row['label'])
+            axes = line.axes
+            axes.relim()
+            axes.autoscale_view()
+            axes.legend()
+
+
+class BlockWriter(object):
+    """A file object that compresses what's written in blocks.
+
+    The data is cut in fixed size blocks & each one is compressed on its own
+    in a thread pool (zlib & lzma let the other threads run meanwhile), then
+    they're written in order. Every block is a whole gzip member (or xz
+    stream), so the output can still be read by gunzip (or xz) as a single
+    file. At most two blocks per thread are in flight.
+    """
+
+    def __init__(self, fileobj, compress, threads=1, block_size=1024 ** 2):
+        """Customize the object.
+
+        Compress is a function turning a block (bytes) into a member. With a
+        single thread the blocks are compressed right away.
+        """
+        self.fileobj = fileobj
+        self.compress = compress
+        self.threads = threads
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = deque()  # futures in write order
+        self.pool = None
+        if threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self.pool = ThreadPoolExecutor(threads)
+
+    def write(self, data):
+        """Buffer data & send the full blocks to compress."""
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.Submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def Submit(self, block):
+        """Compress a block (or send it to the pool)."""
+        if self.pool is None:
+            self.fileobj.write(self.compress(block))
+            return
+        self.pending.append(self.pool.submit(self.compress, block))
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        """Compress the last block, write the pending ones & close.
+
+        The pool is shut down & the file closed even if a block fails (the
+        blocks not written yet are dropped), so it can be called again.
+        """
+        try:
+            if self.buffer:
+                block, self.buffer = bytes(self.buffer), bytearray()
+                self.Submit(block)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.pending.clear()
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+            self.fileobj.close()
+
+
+class Cancelled(Exception):
+    """The backup was cancelled while being built (see Compress.Cancel)."""
+
+
+def FileStat(path):
+    """Stat a file to backup without following links.
+
+    Links are backed up as links (dangling ones too), so they're stat'ed
+    themselves. Returns the os.stat_result, or None if it's neither a
+    regular file nor a link (FIFOs, sockets & devices, which can't be read
+    to the end).
+    """
+    import stat
+    info = os.lstat(path)
+    if stat.S_ISREG(info.st_mode) or stat.S_ISLNK(info.st_mode):
+        return info
+    return None
+
 
 class Compress(object):
     """Compress and move to the backup folder."""
 
+    # Extension, compression level & block size per BACKUP_COMPRESSION (xz
+    # gets bigger blocks since its dictionary is bigger)
+    FORMATS = {'gz': ('.tar.gz', 9, 1024 ** 2),
+               'xz': ('.tar.xz', 6, 8 * 1024 ** 2),
+               'zst': ('.tar.zst', 3, None),
+               }
+
+    # The manifest of each tarball is its first member
+    MANIFEST = '.pnr/manifest.json'
+
+    def __init__(self, quiet=False):
+        """Customize the object.
+
+        A quiet object keeps its messages until Finish, so a backup built in
+        the background doesn't mess the reports up.
+        """
+        self.quiet = quiet
+        self.messages = []
+        self.manifest = None  # of the tarball built, see Plan
+        self.sources = {}  # path on disk of each file in it, see Plan
+        self.stop = threading.Event()  # see Cancel
+        self.lock = threading.Lock()
+        self.processes = set()  # pg_dumps running
+
+    def Say(self, *args):
+        """Print a message (or keep it if quiet)."""
+        message = ' '.join(str(arg) for arg in args)
+        if self.quiet:
+            self.messages.append(message)
+        else:
+            print(message)
+
     def Output(self):
         """Create the backup from its elements."""
-        if Settings.PG_BACKUPDB:
-            print('Backup postgres...')
-            self.Postgres()
-        self.TarFilize()
-        self.Move()
+        self.Finish(self.Build())
+
+    def Build(self):
+        """Dump the dbs & create the tarball, returns its name.
+
+        It never asks anything, so it can be run in the background. With
+        BACKUP_FORMAT chunks there's no tarball (None is returned), files are
+        stored by Finish once the backup folder is there (see ChunkStore).
+        """
+        try:
+            self.Check()
+            if Settings.PG_BACKUPDB and not self.Streaming():
+                self.Say('Backup postgres...')
+                self.Postgres()
+            if getattr(Settings, 'BACKUP_FORMAT', 'tarball') == 'chunks':
+                return None
+            return self.TarFilize()
+        except BaseException:
+            # Cancelled or failed, leave no dumps behind (see TarFilize for
+            # the tarball)
+            shutil.rmtree(self.DumpPath(), ignore_errors=True)
+            raise
+
+    def Cancel(self):
+        """Stop the backup being built, it's meant to be called from another
+        thread than Build's.
+
+        The pg_dumps running are killed, with any process they started (like
+        the workers of -j), & Build raises Cancelled as soon as
+        it checks (see Check), leaving neither tarball nor dumps behind.
+        """
+        import signal
+        self.stop.set()
+        with self.lock:
+            for process in self.processes:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def Check(self, info=None):
+        """Raise Cancelled if the backup was cancelled.
+
+        Returns info, so it can be the filter of tarfile's add, which is
+        called before each member. Special files (as in Paths) are left out
+        returning None.
+        """
+        if self.stop.is_set():
+            raise Cancelled('backup cancelled')
+        if info is not None and not (info.isreg() or info.isdir() or
+                                     info.issym() or info.islnk()):
+            return None
+        return info
+
+    def Run(self, args, **kwargs):
+        """Start a pg_dump, so it's killed if the backup is cancelled.
+
+        It's the leader of a new process group, so Cancel can kill what it
+        starts too. Returns the subprocess.Popen object, see Finished.
+        """
+        import subprocess
+        env = dict(os.environ, PGPASSWORD=Settings.PG_PASS)
+        with self.lock:
+            self.Check()
+            process = subprocess.Popen(args, env=env, start_new_session=True,
+                                       **kwargs)
+            self.processes.add(process)
+        return process
+
+    def Finished(self, process):
+        """Wait for a pg_dump started by Run.
+
+        Raises Cancelled if it was killed by Cancel or CalledProcessError if
+        it failed.
+        """
+        import subprocess
+        returncode = process.wait()
+        with self.lock:
+            self.processes.discard(process)
+        self.Check()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, process.args)
+
+    def Finish(self, name):
+        """Move the tarball created by Build to the backup folder."""
+        for message in self.messages:
+            print(message)
+        self.messages = []
+        if name is None:
+            Ask('Dbs dumped ok!, insert an usb stick & hit any key', 'usb')
+            self.Store()
+        else:
+            Ask('Tarball created ok!, insert an usb stick & hit any key',
+                'usb')
+            self.Move()
+            if self.manifest is not None:
+                self.SaveManifest(self.manifest)
         print('Backup successfully completed!')
 
+    def Discard(self, name):
+        """Remove what Build made (a tarball or dumps) that won't be used."""
+        if name is not None:
+            os.remove(os.path.join(Settings.home, name))
+        shutil.rmtree(self.DumpPath(), ignore_errors=True)
+
+    def DumpPath(self):
+        """Get the folder for the db backups (it's emptied on each backup)."""
+        default = os.path.join(Settings.home, '.pnr_dumps')
+        return getattr(Settings, 'PG_DUMP_DIR', default)
+
+    def Dump(self, db):
+        """Dump a db into the dump folder, returns the path of the dump.
+
+        Dumps are compressed custom format (-Fc) files, or with PG_DUMP_FORMAT
+        directory, folders dumped by PG_DUMP_JOBS (2) connections at once.
+        """
+        s = Settings
+        args = ['pg_dump', '-h', s.PG_HOST, '-U', s.PG_USER]
+        if getattr(s, 'PG_DUMP_FORMAT', 'custom') == 'directory':
+            path = os.path.join(self.DumpPath(), db + '.dir')
+            args += ['-Fd', '-j', str(getattr(s, 'PG_DUMP_JOBS', 2))]
+        else:
+            path = os.path.join(self.DumpPath(), db + '.dump')
+            args += ['-Fc']
+        args += ['-f', path, db]
+        self.Finished(self.Run(args))
+        return path
+
     def Postgres(self):
-        """Create a backup from the tables defined on settings."""
+        """Create a backup from the tables defined on settings.
+
+        Dbs are dumped at once, PG_WORKERS (4) of them at most (see Dump).
+        """
+        from concurrent.futures import ThreadPoolExecutor
         s = Settings
-        os.putenv('PGPASSWORD', s.PG_PASS)
-        os.chdir(s.home)
-        for db in s.PG_DATABASES:
-            filename = db + '_backup.sql'
-            with open(filename, 'w') as f:
-                pg_dump('-h', s.PG_HOST, '-U', s.PG_USER, db, _out=f)
+        shutil.rmtree(self.DumpPath(), ignore_errors=True)
+        os.makedirs(self.DumpPath())
+        workers = max(1, min(getattr(s, 'PG_WORKERS', 4),
+                             len(s.PG_DATABASES)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for path in pool.map(self.Dump, s.PG_DATABASES):
+                self.Say(os.path.basename(path), '-> dumped ok.')
+
+    def Streaming(self):
+        """Tell if the dbs are dumped straight into the tarball.
+
+        Custom format dumps into a tarball are streamed (see StreamDumps)
+        unless PG_STREAM is False, the rest are written to files first.
+        """
+        s = Settings
+        return (s.PG_BACKUPDB and getattr(s, 'PG_STREAM', True) and
+                getattr(s, 'PG_DUMP_FORMAT', 'custom') == 'custom' and
+                getattr(s, 'BACKUP_FORMAT', 'tarball') == 'tarball')
+
+    def Stream(self, db, parts):
+        """Run pg_dump for a db putting its output on a queue.
+
+        The output is cut in parts of PG_PART_SIZE (8MB), each one a (name,
+        data) tuple, named db.dump if there's only one or db.dump.part000,
+        part001... otherwise. None is put when done, even on errors. If the
+        backup is cancelled pg_dump is killed.
+        """
+        import subprocess
+        s = Settings
+        size = getattr(s, 'PG_PART_SIZE', 8 * 1024 ** 2)
+        args = ['pg_dump', '-h', s.PG_HOST, '-U', s.PG_USER, '-Fc', db]
+        stop = self.stop
+        try:
+            process = self.Run(args, stdout=subprocess.PIPE)
+            with process.stdout:
+                block, idx = process.stdout.read(size), 0
+                while not stop.is_set():
+                    following = b''
+                    if len(block) == size:  # read ahead to name the part
+                        following = process.stdout.read(size)
+                    name = db + '.dump'
+                    if idx or following:
+                        name = '%s.dump.part%03d' % (db, idx)
+                    parts.put((name, block))
+                    if not following:
+                        break
+                    block, idx = following, idx + 1
+                if stop.is_set():
+                    process.kill()
+            self.Finished(process)
+        finally:
+            parts.put(None)
+
+    def StreamDumps(self, tar):
+        """Dump the dbs straight into the tarball, no files in between.
+
+        Dbs are dumped at once, PG_WORKERS (4) of them at most, & their parts
+        (see Stream) added as members as they come. The queue holds a part
+        per worker, so about 4 parts per worker are in memory at most.
+        """
+        import io
+        import queue
+        import tarfile
+        from concurrent.futures import ThreadPoolExecutor
+        dbs = Settings.PG_DATABASES
+        workers = max(1, min(getattr(Settings, 'PG_WORKERS', 4), len(dbs)))
+        parts = queue.Queue(maxsize=workers)
+        finished = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.Stream, db, parts) for db in dbs]
+            try:
+                while finished < len(dbs):
+                    part = parts.get()
+                    if part is None:
+                        finished += 1
+                        continue
+                    name, data = part
+                    info = tarfile.TarInfo(name)
+                    info.size, info.mode = len(data), 0o600
+                    info.mtime = datetime.now().timestamp()
+                    tar.addfile(info, io.BytesIO(data))
+                    self.Say(name, '-> streamed ok.')
+            finally:
+                # Let the workers go on (& stop) if the tarball failed
+                if finished < len(dbs):
+                    self.Cancel()
+                    while finished < len(dbs):
+                        if parts.get() is None:
+                            finished += 1
+        for future in futures:
+            future.result()
+
+    def Format(self):
+        """Get the compression of the tarball from the settings.
+
+        Zstandard is optional, if it's not installed gzip is used instead.
+        Returns a str (see FORMATS).
+        """
+        compression = getattr(Settings, 'BACKUP_COMPRESSION', 'gz')
+        if compression not in self.FORMATS:
+            raise ValueError('compression unknown (%s)' % compression)
+        if compression == 'zst':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                self.Say('Warning: zstandard is not installed, using gz')
+                compression = 'gz'
+        return compression
+
+    def Writer(self, fileobj, compression):
+        """Wrap a file object to compress the tarball on several threads.
+
+        Threads default to the number of cpus (Settings.BACKUP_THREADS).
+        Returns a file object, the tarball must be written as a stream.
+        """
+        threads = getattr(Settings, 'BACKUP_THREADS', os.cpu_count() or 1)
+        _, level, block_size = self.FORMATS[compression]
+        block_size = getattr(Settings, 'BACKUP_BLOCK_SIZE', block_size)
+        if compression == 'zst':
+            import zstandard
+            compressor = zstandard.ZstdCompressor(level=level,
+                                                  threads=threads)
+            return compressor.stream_writer(fileobj)
+        if compression == 'gz':
+            import gzip
+
+            def compress(block):
+                return gzip.compress(block, compresslevel=level, mtime=0)
+        else:
+            import lzma
+
+            def compress(block):
+                return lzma.compress(block, preset=level)
+        return BlockWriter(fileobj, compress, threads, block_size)
+
+    def ManifestPath(self):
+        """Get the path of the manifest of the last backup made."""
+        default = os.path.join(Settings.home, '.pnr_manifest.json')
+        return getattr(Settings, 'BACKUP_MANIFEST', default)
+
+    def LoadManifest(self):
+        """Get the manifest of the last backup made (None if there's none)."""
+        try:
+            with open(self.ManifestPath()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def SaveManifest(self, manifest):
+        """Store the manifest of the last backup made."""
+        path = self.ManifestPath()
+        with open(path + '.part', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + '.part', path)
+
+    def Hash(self, path):
+        """Get the sha256 of a file as an hex str.
+
+        Links are not followed, the hash is that of the path they point to.
+        """
+        import hashlib
+        digest = hashlib.sha256()
+        if os.path.islink(path):
+            digest.update(os.fsencode(os.readlink(path)))
+            return digest.hexdigest()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 ** 2), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def Paths(self):
+        """Get the files to backup (in BACKUP_FOLDERS & BACKUP_FILES).
+
+        Links (to folders too) are kept as links & special files (like
+        FIFOs) are skipped, see FileStat. Returns a list of (path in the
+        backup, path on disk) tuples.
+        """
+        home = Settings.home
+        paths = []
+        for i in Settings.BACKUP_FOLDERS:
+            folder = os.path.join(home, i)
+            if not os.path.isdir(folder):
+                self.Say('Warning: folder %s doesn\'t exist, skipping...' % i)
+                continue
+            for root, dirs, files in os.walk(folder):
+                dirs.sort()
+                links = [name for name in dirs
+                         if os.path.islink(os.path.join(root, name))]
+                for name in sorted(files + links):
+                    path = os.path.join(root, name)
+                    arcname = os.path.join(i, os.path.relpath(path, folder))
+                    if FileStat(path) is None:
+                        self.Say('Warning: %s is not a regular file, ' %
+                                 arcname + 'skipping...')
+                        continue
+                    paths.append((arcname, path))
+        for i in Settings.BACKUP_FILES:
+            if not os.path.isfile(os.path.join(home, i)):
+                self.Say('Warning: file %s doesn\'t exist, skipping...' % i)
+                continue
+            paths.append((i, os.path.join(home, i)))
+        return [(os.path.normpath(arcname).lstrip('/'), path)
+                for arcname, path in paths]
+
+    def Dumps(self):
+        """Get the db backups made by Postgres.
+
+        Returns a list of (path in the backup, path on disk) tuples, with
+        the files of directory dumps one by one.
+        """
+        folder = self.DumpPath()
+        dumps = []
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                dumps.append((os.path.relpath(path, folder), path))
+        return dumps
+
+    def Scan(self, paths, known=None):
+        """Get the files to backup with their hash.
+
+        Paths are (path in the tarball, path on disk) tuples (see Paths).
+        Files with the same size & mtime as in known (the files of a former
+        manifest) keep their hash, the rest are read to hash them. Returns
+        a dict with the path in the tarball as key & [size, mtime (ns),
+        sha256] as value.
+        """
+        known = known or {}
+        result = {}
+        for arcname, path in paths:
+            self.Check()
+            stat = FileStat(path)
+            entry = [stat.st_size, stat.st_mtime_ns]
+            if known.get(arcname, [None, None])[:2] == entry:
+                entry.append(known[arcname][2])
+            else:
+                entry.append(self.Hash(path))
+            result[arcname] = entry
+        return result
+
+    def Plan(self, name):
+        """Decide what goes into the tarball.
+
+        With BACKUP_MODE incremental (the default) only the files new or
+        changed since the last backup are taken, along with the list of the
+        deleted ones, but every BACKUP_FULL_EVERY (7) backups a full one is
+        made to start a new chain. Returns the manifest of the tarball, with
+        its name, kind (full or incremental), base (the backup it follows),
+        chain (backups since the last full one), files (all of them, see
+        Scan), added & deleted (both lists of paths). The path on disk of
+        each file is kept in sources, since folders may be out of home.
+        """
+        last = self.LoadManifest()
+        mode = getattr(Settings, 'BACKUP_MODE', 'incremental')
+        every = getattr(Settings, 'BACKUP_FULL_EVERY', 7)
+        full = (last is None or mode == 'full' or last['chain'] + 1 >= every)
+        paths = self.Paths()
+        self.sources = dict(paths)
+        files = self.Scan(paths, None if last is None else last['files'])
+        if full:
+            manifest = {'kind': 'full', 'base': None, 'chain': 0,
+                        'added': sorted(files), 'deleted': []}
+        else:
+            manifest = {'kind': 'incremental', 'base': last['name'],
+                        'chain': last['chain'] + 1,
+                        'added': sorted(path for path in files
+                                        if files[path] !=
+                                        last['files'].get(path)),
+                        'deleted': sorted(set(last['files']) - set(files))}
+        manifest.update(name=name, files=files)
+        return manifest
 
     def TarFilize(self):
-        """Create a backup tarball."""
-        print('Tarbal creation start...')
+        """Create a backup tarball.
+
+        Paths are taken from home but the working dir is left alone, since
+        it may be run in the background. The tarball is compressed on several
+        threads (see Writer) & holds the files planned (see Plan) after its
+        manifest. Returns the name of the tarball.
+        """
+        import io
+        import tarfile
+        self.Say('Tarbal creation start...')
 
+        compression = self.Format()
         now = datetime.now()
-        name = (str(now.date()) + '-' + str(now.hour) + str(now.minute) +
-                '.tar.gz')
+        self.manifest = self.Plan(now.strftime('%Y-%m-%d-%H%M%S'))
+        name = (self.manifest['name'] + '-' + self.manifest['kind'] +
+                self.FORMATS[compression][0])
+        self.manifest['name'] = name
+        self.Say('%s backup, %s files changed, %s deleted' %
+                 (self.manifest['kind'], len(self.manifest['added']),
+                  len(self.manifest['deleted'])))
 
         # Now, create the file
-        os.chdir(Settings.home)
-        tar = tarfile.open(name, 'w:gz')
-        folder_list = (Settings.BACKUP_FOLDERS)
-        file_list = (Settings.BACKUP_FILES)
-
-        for i in folder_list:
-            checkfolder = os.path.isdir(i)
-            if checkfolder is True:
-                tar.add(i)
+        home = Settings.home
+        tarball = os.path.join(home, name)
+        writer = self.Writer(open(tarball, 'wb'), compression)
+        try:
+            tar = tarfile.open(fileobj=writer, mode='w|')
+            data = json.dumps(self.manifest).encode()
+            info = tarfile.TarInfo(self.MANIFEST)
+            info.size, info.mtime = len(data), now.timestamp()
+            tar.addfile(info, io.BytesIO(data))
+
+            if self.manifest['kind'] == 'full':
+                # whole folders, so empty ones are kept too
+                for i in Settings.BACKUP_FOLDERS:
+                    if os.path.isdir(os.path.join(home, i)):
+                        tar.add(os.path.join(home, i), arcname=i,
+                                filter=self.Check)
+                for i in Settings.BACKUP_FILES:
+                    if os.path.isfile(os.path.join(home, i)):
+                        tar.add(os.path.join(home, i), arcname=i,
+                                filter=self.Check)
             else:
-                print('Warning: folder %s doesn\'t exist, skipping...' % i)
-
-        for i in file_list:
-            checkfile = os.path.isfile(i)
-            if checkfile is True:
-                tar.add(i)
-            else:
-                print('Warning: file %s doesn\'t exist, skipping...' % i)
-
-        # Look for all the db backups (.sql) in the dir & move'em
-        for line in os.listdir(Settings.home):
-            if re.search(r'.sql', line):
-                print(line, '-> !file found, adding...')
-                tar.add(line)
-                print('Added ok.')
-                os.remove(line)
+                for arcname in self.manifest['added']:
+                    tar.add(self.sources[arcname], arcname=arcname,
+                            filter=self.Check)
+
+            # Add the db backups made by Postgres & remove'em
+            if self.Streaming():
+                self.Say('Backup postgres...')
+                self.StreamDumps(tar)
+            dumps = self.Dumps()
+            for arcname, path in dumps:
+                self.Say(arcname, '-> !file found, adding...')
+                tar.add(path, arcname=arcname, filter=self.Check)
+                self.Say('Added ok.')
+            if dumps:
+                shutil.rmtree(self.DumpPath())
+
+            tar.close()
+            writer.close()
+        except BaseException:
+            # Leave no truncated tarball behind for Move (or a later chain)
+            try:
+                writer.close()
+            except Exception:
+                pass
+            os.remove(tarball)
+            self.manifest = None
+            raise
+        return name
+
+    def Reader(self, path):
+        """Open a tarball made by TarFilize to read it as a stream.
+
+        Blocks are several gzip members (or xz streams), which tarfile's
+        own streams don't read, so the file is opened by gzip (or lzma).
+        Returns a tarfile object.
+        """
+        import tarfile
+        if path.endswith('.zst'):
+            import zstandard
+            fileobj = zstandard.ZstdDecompressor().stream_reader(
+                open(path, 'rb'), closefd=True)
+        elif path.endswith('.xz'):
+            import lzma
+            fileobj = lzma.open(path)
+        else:
+            import gzip
+            fileobj = gzip.open(path)
+        tar = tarfile.open(fileobj=fileobj, mode='r|')
+        tar.source = fileobj  # tarfile doesn't close a given fileobj
+        return tar
 
-        tar.close()
-        input('Tarball created ok!, insert an usb stick & hit any key')
+    def Backups(self, folder):
+        """Get the manifests of the tarballs in a folder.
 
-    def Move(self):
-        """Move the backup tarball to the aux device."""
-        org = Settings.home
+        Returns a dict with the tarball name as key & its manifest as value.
+        """
+        backups = {}
+        for name in os.listdir(folder):
+            if not re.search(r'\.tar\.(gz|xz|zst)$', name):
+                continue
+            tar = self.Reader(os.path.join(folder, name))
+            member = tar.next()
+            if member is not None and member.name == self.MANIFEST:
+                manifest = json.loads(tar.extractfile(member).read())
+                backups[manifest['name']] = manifest
+            tar.close()
+            tar.source.close()
+        return backups
+
+    def Restore(self, target, name=None, folder=None):
+        """Rebuild the files as they were on a backup.
+
+        Name is the tarball (the last one by default) in folder (by default
+        BACKUP_TARGET). The chain of backups from the last full one is read
+        in order & each file is taken from the last tarball that has it, so
+        files deleted meanwhile are left out. Files are checked against
+        their hash. Returns the list of files restored.
+        """
+        import tarfile
+        folder = folder or Settings.BACKUP_TARGET
+        backups = self.Backups(folder)
+        if not backups:
+            raise ValueError('no backups found in %s' % folder)
+        if name is None:
+            name = max(backups)
+        if name not in backups:
+            raise ValueError('backup %s not found' % name)
+        chain = [backups[name]]
+        while chain[0]['base'] is not None:
+            if chain[0]['base'] not in backups:
+                raise ValueError('backup %s is missing' % chain[0]['base'])
+            chain.insert(0, backups[chain[0]['base']])
+        point = chain[-1]
+        source = {}  # path: the tarball to take it from
+        for manifest in chain:
+            for path in manifest['added']:
+                source[path] = manifest['name']
+
+        os.makedirs(target, exist_ok=True)
+        extract = {}
+        if hasattr(tarfile, 'data_filter'):
+            extract['filter'] = 'data'
+        restored = []
+        parts = {}  # streamed dump: number of parts put together
+        for manifest in chain:
+            tar = self.Reader(os.path.join(folder, manifest['name']))
+            for member in tar:
+                path = member.name
+                if path == self.MANIFEST:
+                    continue
+                tracked = path in point['files']
+                if member.isdir() or (tracked and
+                                      source.get(path) == manifest['name']):
+                    tar.extract(member, target, **extract)
+                elif not tracked and manifest is point:
+                    part = re.search(r'^(\w[^/]*)\.part(\d+)$', path)
+                    if part:  # streamed dumps are put together again
+                        dump, idx = part.group(1), int(part.group(2))
+                        if idx != parts.get(dump, 0):
+                            raise ValueError('part %s of %s is missing' %
+                                             (parts.get(dump, 0), dump))
+                        parts[dump] = idx + 1
+                        with open(os.path.join(target, dump),
+                                  'ab' if idx else 'wb') as f:
+                            shutil.copyfileobj(tar.extractfile(member), f)
+                    else:
+                        tar.extract(member, target, **extract)  # db dumps
+                else:
+                    continue
+                if tracked:
+                    digest = self.Hash(os.path.join(target, path))
+                    if digest != point['files'][path][2]:
+                        raise ValueError('%s doesn\'t match its hash' % path)
+                    restored.append(path)
+            tar.close()
+            tar.source.close()
+        return restored
+
+    def Target(self):
+        """Get the backup folder, asking for it if it can't be found."""
         dst = Settings.BACKUP_TARGET
 
         checkdir = os.path.isdir(dst)
         while not checkdir:
-            dst = input('Couldn\'t find that location, ' +
-                        'choose manually [q, quit]: ')
+            dst = Ask('Couldn\'t find that location, ' +
+                      'choose manually [q, quit]: ', 'target')
             if dst == 'q':
                 raise KeyboardInterrupt('Process interrupted by user')
 
             checkdir = os.path.isdir(dst)
+        return dst
 
-        # Look for all the backup tarballs (.bak.tar.gz) in the dir & move'em
+    def Move(self):
+        """Move the backup tarball to the aux device."""
+        org = Settings.home
+        dst = self.Target()
+
+        # Look for all the backup tarballs (.tar.gz, xz, zst) & move'em
         for line in os.listdir(org):
-            if re.search(r'.tar.gz', line):
+            if re.search(r'\.tar\.(gz|xz|zst)$', line):
                 print(line, '-> !file found, moving...')
                 start = org + line
                 end = dst + line
                 shutil.move(start, end)
                 print('Moved ok.')
 
+    def StorePath(self):
+        """Get the chunk store folder, BACKUP_STORE or in the backup one."""
+        if hasattr(Settings, 'BACKUP_STORE'):
+            return Settings.BACKUP_STORE
+        return os.path.join(self.Target(), 'pnr-store')
+
+    def Store(self):
+        """Store the files & the db backups in the chunk store.
+
+        Only the chunks not stored yet are written (see ChunkStore.Backup).
+        """
+        store = ChunkStore(self.StorePath())
+        dumps = self.Dumps()
+        paths = self.Paths() + dumps
+        name = datetime.now().strftime('%Y-%m-%d-%H%M%S')
+        chunks, size = store.Backup(name, paths)
+        print('Snapshot %s stored, %s files, %s new chunks (%.1fMB)' %
+              (name, len(paths), chunks, size / 1024 ** 2))
+        if dumps:
+            shutil.rmtree(self.DumpPath())
+
+
+class ChunkStore(object):
+    """Keep the backups as chunks of the files, so each one is stored once.
+
+    Files are cut where the content says so (see Cuts), not at fixed
+    offsets, so an edit only changes the chunks around it. The store is a
+    folder with the chunks (zlib compressed & named after the sha256 of
+    their data), an index with the size of each chunk & a snapshot per
+    backup with the chunks of each file.
+    """
+
+    # Chunks are 256KB on average (a cut every 2 ** 18 bytes)
+    MIN_SIZE = 64 * 1024
+    MAX_SIZE = 1024 ** 2
+    MASK = 2 ** 18 - 1
+    READ_SIZE = 8 * 1024 ** 2
+
+    def __init__(self, path):
+        """Open the store in path (it's created on the first Backup)."""
+        self.path = path
+        self.gear = None
+        try:
+            with open(os.path.join(path, 'index.json')) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+
+    def Write(self, path, data):
+        """Write a file at once, so there are no half written files."""
+        mode = 'w' if isinstance(data, str) else 'wb'
+        with open(path + '.part', mode) as f:
+            f.write(data)
+        os.replace(path + '.part', path)
+
+    def Hash(self, data):
+        """Get the gear hash at each byte of data.
+
+        The hash at a byte is the sum of the gear value of the last 32 bytes
+        shifted by their distance (on 32 bits), so it's the same wherever
+        they are. Sums are doubled up, 5 passes rather than 32. Returns an
+        array of uint32.
+        """
+        import numpy as np
+        if self.gear is None:
+            random = np.random.RandomState(0x706e72)  # the same everywhere
+            self.gear = random.randint(0, 2 ** 32, 256,
+                                       dtype=np.uint64).astype(np.uint32)
+        result = self.gear[np.frombuffer(data, dtype=np.uint8)]
+        span = 1
+        while span < 32:
+            result[span:] += result[:-span] << np.uint32(span)
+            span *= 2
+        return result
+
+    def Cuts(self, data, final):
+        """Find where to cut data in chunks.
+
+        Cuts are made where the hash has the bits in MASK clear, as long as
+        the chunk is within MIN_SIZE & MAX_SIZE. The rest after the last cut
+        is left for the next read unless final. Returns a list of offsets.
+        """
+        import numpy as np
+        candidates = np.flatnonzero((self.Hash(data) & self.MASK) == 0) + 1
+        cuts, start = [], 0
+        for cut in candidates.tolist():
+            while cut - start > self.MAX_SIZE:
+                start += self.MAX_SIZE
+                cuts.append(start)
+            if cut - start >= self.MIN_SIZE:
+                cuts.append(cut)
+                start = cut
+        while len(data) - start > self.MAX_SIZE:
+            start += self.MAX_SIZE
+            cuts.append(start)
+        if final and start < len(data):
+            cuts.append(len(data))
+        return cuts
+
+    def Chunks(self, f):
+        """Read a file in chunks (see Cuts), yields bytes."""
+        data = b''
+        while True:
+            block = f.read(self.READ_SIZE)
+            data += block
+            start = 0
+            for cut in self.Cuts(data, not block):
+                yield data[start:cut]
+                start = cut
+            data = data[start:]
+            if not block:
+                return
+
+    def ChunkPath(self, digest):
+        """Get the path of a chunk, in a folder per first 2 hex digits."""
+        return os.path.join(self.path, 'chunks', digest[:2], digest)
+
+    def Put(self, chunk):
+        """Store a chunk unless it's there already, returns its sha256."""
+        import hashlib
+        import zlib
+        digest = hashlib.sha256(chunk).hexdigest()
+        if digest not in self.index:
+            path = self.ChunkPath(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.Write(path, zlib.compress(chunk))
+            self.index[digest] = len(chunk)
+        return digest
+
+    def Get(self, digest):
+        """Get the data of a chunk checking its hash."""
+        import hashlib
+        import zlib
+        with open(self.ChunkPath(digest), 'rb') as f:
+            chunk = zlib.decompress(f.read())
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise ValueError('chunk %s doesn\'t match its hash' % digest)
+        return chunk
+
+    def Snapshots(self):
+        """Get the names of the snapshots stored, oldest first."""
+        folder = os.path.join(self.path, 'snapshots')
+        if not os.path.isdir(folder):
+            return []
+        return sorted(name[:-len('.json')] for name in os.listdir(folder)
+                      if name.endswith('.json'))
+
+    def Snapshot(self, name):
+        """Get the files of a snapshot.
+
+        Returns a dict with the path as key & [size, mtime (ns), sha256,
+        chunks] as value, links having 'link' last (see Backup).
+        """
+        with open(os.path.join(self.path, 'snapshots', name + '.json')) as f:
+            return json.load(f)
+
+    def Backup(self, name, paths):
+        """Store a snapshot of some files.
+
+        Paths is a list of (path in the backup, path on disk) tuples. Files
+        with the same size & mtime as in the last snapshot aren't read again.
+        Links are stored as links, the path they point to being their data,
+        & special files are skipped (see FileStat). Chunks are written first, then the index & the snapshot last, so a
+        snapshot only lists stored chunks. Returns a tuple with the number of
+        chunks written & their size.
+        """
+        import hashlib
+        snapshots = self.Snapshots()
+        last = self.Snapshot(snapshots[-1]) if snapshots else {}
+        os.makedirs(os.path.join(self.path, 'snapshots'), exist_ok=True)
+        stored = len(self.index)
+        size = sum(self.index.values())
+        files = {}
+        for arcname, path in paths:
+            stat = FileStat(path)
+            if stat is None:
+                continue
+            entry = [stat.st_size, stat.st_mtime_ns]
+            kind = ['link'] if os.path.islink(path) else []
+            known = last.get(arcname, [None, None])
+            if known[:2] + known[4:] == entry + kind:
+                files[arcname] = known
+                continue
+            digest = hashlib.sha256()
+            chunks = []
+            if kind:
+                data = os.fsencode(os.readlink(path))
+                digest.update(data)
+                chunks.append(self.Put(data))
+            else:
+                with open(path, 'rb') as f:
+                    for chunk in self.Chunks(f):
+                        digest.update(chunk)
+                        chunks.append(self.Put(chunk))
+            files[arcname] = entry + [digest.hexdigest(), chunks] + kind
+        self.Write(os.path.join(self.path, 'index.json'),
+                   json.dumps(self.index))
+        self.Write(os.path.join(self.path, 'snapshots', name + '.json'),
+                   json.dumps(files))
+        return (len(self.index) - stored, sum(self.index.values()) - size)
+
+    def Restore(self, target, name=None):
+        """Rebuild the files of a snapshot (the last one by default).
+
+        Each file is checked against its hash. Returns the list of files
+        restored.
+        """
+        import hashlib
+        snapshots = self.Snapshots()
+        if not snapshots:
+            raise ValueError('no snapshots found in %s' % self.path)
+        files = self.Snapshot(name or snapshots[-1])
+        for arcname in sorted(files):
+            size, mtime, sha256, chunks = files[arcname][:4]
+            path = os.path.join(target, arcname)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            digest = hashlib.sha256()
+            link = files[arcname][4:] == ['link']
+            if link:
+                data = b''.join(self.Get(chunk) for chunk in chunks)
+                digest.update(data)
+                if os.path.lexists(path):
+                    os.remove(path)
+                os.symlink(os.fsdecode(data), path)
+            else:
+                with open(path, 'wb') as f:
+                    for chunk in chunks:
+                        data = self.Get(chunk)
+                        digest.update(data)
+                        f.write(data)
+            if digest.hexdigest() != sha256:
+                raise ValueError('%s doesn\'t match its hash' % arcname)
+            if not link:
+                os.utime(path, ns=(mtime, mtime))
+            elif os.utime in os.supports_follow_symlinks:
+                os.utime(path, ns=(mtime, mtime), follow_symlinks=False)
+        return sorted(files)
+
+    def Verify(self):
+        """Check the store without restoring it.
+
+        Every chunk in the index is read & checked against its hash & size,
+        and every chunk in the snapshots must be in the index. Returns a
+        list of the problems found (empty if none).
+        """
+        import zlib
+        problems = []
+        for digest in sorted(self.index):
+            try:
+                chunk = self.Get(digest)
+            except (OSError, ValueError, zlib.error) as error:
+                problems.append('chunk %s: %s' % (digest, error))
+                continue
+            if len(chunk) != self.index[digest]:
+                problems.append('chunk %s: wrong size' % digest)
+        for name in self.Snapshots():
+            files = self.Snapshot(name)
+            for arcname in sorted(files):
+                missing = [chunk for chunk in files[arcname][3]
+                           if chunk not in self.index]
+                if missing:
+                    problems.append('%s in snapshot %s misses %s chunks' %
+                                    (arcname, name, len(missing)))
+        return problems
+
+
+class Pipeline(object):
+    """Get several reports ready at once & output them in order."""
+
+    def __init__(self, jobs, workers=None):
+        """Customize the object.
+
+        Jobs is a list of callables, each one returning a report ready to be
+        output. Workers defaults to Settings.report_workers (4 if missing).
+        """
+        if workers is None:
+            workers = getattr(Settings, 'report_workers', 4)
+        self.jobs = jobs
+        self.workers = workers
+
+    def Run(self):
+        """Run the jobs on a thread pool.
+
+        With a single worker (or none) they run one after another. Returns a
+        list with their results in the same order as the jobs.
+        """
+        if self.workers <= 1:
+            return [job() for job in self.jobs]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [pool.submit(job) for job in self.jobs]
+            return [future.result() for future in futures]
+
+    def Output(self):
+        """Run the jobs & output the reports in order."""
+        for report in self.Run():
+            report.Output()
+
 
 class Menu(object):
     """Display the main menu."""
 
     def __new__(self):
-        """Instantiate the data from db."""
-        last_entries = LastEntries()
-        week = Week()
-        year = Year()
-        graph = Graph()
+        """Instantiate the data from db.
+
+        The db is extracted, opened & cleaned just once & shared by all the
+        reports. The daily sums are kept in the rollup, which is brought up
+        to date from the days changed only (see Rollup.Update), so the
+        history is not added up on every run. With db_snapshot the db is
+        read just once (see OpenDb).
+        The reports are computed at once (see Pipeline). With
+        BACKUP_BACKGROUND the tarball is built meanwhile, it's stopped & thrown
+        away if the backup is declined.
+        """
+        db = OpenDb()
+        rollup = Rollup(db)
+        rollup.Refresh()
+        reports = Pipeline([lambda: LastEntries(db).Fetch(),
+                            lambda: Week(rollup),
+                            lambda: Year(rollup),
+                            lambda: Graph(rollup).Fetch(),
+                            ])
+
+        background = getattr(Settings, 'BACKUP_BACKGROUND', False)
+        compress = Compress(quiet=background)
+        if background:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(1)
+            tarball = pool.submit(compress.Build)
+
+        backup = False
+        try:
+            reports.Output()
+            TrackDB().CleanUp()  # & Clean the tmp folder.
+            backup = Ask('Press k to backup: ', 'backup') == 'k'
+        finally:
+            # also when a question can't be answered (see Ask), on errors &
+            # on ctrl-c, the build is stopped rather than waited for
+            if background and not backup:
+                compress.Cancel()
+                try:
+                    compress.Discard(tarball.result())
+                except Cancelled:
+                    pass
+                except Exception as error:
+                    print('Warning: the backup failed (%s)' % error)
 
-        last_entries.Output()
-        week.Output()
-        year.Output()
-        graph.Output()
+        if backup:
+            if background:
+                compress.Finish(tarball.result())
+            else:
+                compress.Output()
+        if background:
+            pool.shutdown()
+
+
+class Command(object):
+    """Run the reports or the backup from the command line (see Usage)."""
+
+    def __init__(self, argv=None):
+        """Parse the arguments (sys.argv by default)."""
+        from docopt import docopt
+        self.args = docopt(__doc__, argv=argv)
+
+    def Answers(self):
+        """Get the answers given by the flags as a dict (see Ask)."""
+        answers = {}
+        if self.args['--yes']:
+            answers.update(graph='g', backup='k', usb='')
+        if self.args['--no-graph']:
+            answers['graph'] = ''
+        if self.args['--no-backup']:
+            answers['backup'] = ''
+        return answers
+
+    def Run(self):
+        """Run the command given.
+
+        Returns the exit status, questions without answer in batch mode exit
+        with an error (see Ask).
+        """
+        Settings.answers = self.Answers()
+        if self.args['--graph-file']:
+            Settings.graph_files = self.args['--graph-file'].split(',')
+        if self.args['--batch'] or not sys.stdin.isatty():
+            Settings.batch = True
+        Settings.rebuild = self.args['--rebuild']
+        chunks = getattr(Settings, 'BACKUP_FORMAT', 'tarball') == 'chunks'
+        if self.args['restore']:
+            if chunks:
+                store = ChunkStore(Compress().StorePath())
+                restored = store.Restore(self.args['<dir>'],
+                                         self.args['--point'])
+            else:
+                restored = Compress().Restore(self.args['<dir>'],
+                                              self.args['--point'])
+            print('%s files restored in %s' % (len(restored),
+                                               self.args['<dir>']))
+        elif self.args['verify']:
+            if not chunks:
+                print('Nothing to verify, BACKUP_FORMAT is not chunks')
+                return 1
+            store = ChunkStore(Compress().StorePath())
+            if not store.index or not store.Snapshots():
+                print('Nothing to verify, no snapshots in %s' % store.path)
+                return 1
+            problems = store.Verify()
+            for problem in problems:
+                print(problem)
+            print('%s chunks in %s snapshots checked, %s problems found' %
+                  (len(store.index), len(store.Snapshots()), len(problems)))
+            return 1 if problems else 0
+        elif self.args['backup']:
+            Compress().Output()
+        elif self.args['last']:
+            LastEntries().Output()
+        elif self.args['week'] or self.args['year'] or self.args['graph']:
+            rollup = Rollup(OpenDb())
+            rollup.Refresh()
+            if self.args['week']:
+                Week(rollup).Output()
+            elif self.args['year']:
+                Year(rollup).Output()
+            else:
+                Graph(rollup).Output()
+        else:
+            Menu()
+        return 0
 
-        if input('Press k to backup: ') == 'k':
-            compress = Compress()
-            compress.Output()
 
 if __name__ == '__main__':
-    show_menu = Menu()
+    sys.exit(Command().Run())
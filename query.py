@@ -0,0 +1,102 @@
+"""Build the queries for the tracker db.
+
+Values are never written into the query text, they're given as :name
+parameters & bound on execution. So, the text for a given shape of query is
+built just once & it's always the same string, which lets the db reuse its
+prepared statement instead of parsing the query on every call.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+# The work table without the deleted entries (see DataYear.Prepare)
+WORK = 'clean_work AS work'
+
+# Joins to get the tag names of the entries
+TAG_JOINS = ('INNER JOIN work_tag ON work.id = work_tag.work_id',
+             'INNER JOIN tag ON tag.id = work_tag.tag_id')
+
+# Half-open time window on the raw started column (see DataYear.Window)
+WINDOW = 'started >= :start AND started < :end'
+
+# Lenght of the entries in seconds
+LENGHT = 'stopped_s - started_s'
+
+# Entries overlapping a window, that is, started before its end & stopped
+# after its start (or started within, if ongoing). Those started more than
+# the longest entry before the window can't reach it, so :reach keeps the
+# predicate an index range (see DataYear.Window)
+OVERLAP = ('started >= :reach AND started < :end AND ' +
+           '(stopped_s > :start_s OR started >= :start)')
+
+# Lenght of the entries clipped to the window
+CLIPPED = 'min(stopped_s, :end_s) - max(started_s, :start_s)'
+
+# The entries overlapping the window split at midnight, a row per day they
+# take up, with the start & stop of each part (day_s is the day at 00:00)
+PARTS = ('WITH RECURSIVE part (id, project, project_name, day_s, start_s, ' +
+         'stop_s) AS (' +
+         'SELECT work.id, project, project_name, ' +
+         'started_s - started_s % 86400, started_s, stopped_s ' +
+         'FROM ' + WORK + ' WHERE ' + OVERLAP +
+         ' UNION ALL ' +
+         'SELECT id, project, project_name, day_s + 86400, day_s + 86400, ' +
+         'stop_s FROM part WHERE stop_s > day_s + 86400)')
+PART = 'part AS work'
+PART_LENGHT = 'min(stop_s, day_s + 86400) - start_s'
+PART_DAY = "date(day_s, 'unixepoch')"
+PART_WINDOW = 'day_s >= :start_s AND day_s < :end_s'
+
+
+@lru_cache(maxsize=None)
+def Select(fields, table=WORK, joins=(), where=(), group=None, order=None,
+           cte=None):
+    """Build the text of a SELECT statement.
+
+    fields is a tuple of (expression, alias) pairs, joins & where are tuples
+    of clauses (the latter are joined with AND) & cte an optional WITH
+    clause. Since all the parts are tuples or strings the result is cached,
+    so the same shape returns the very same string. Returns a string with
+    the query.
+    """
+    fields_str = ', '.join('%s AS %s' % field for field in fields)
+    query = 'SELECT ' + fields_str + ' FROM ' + table
+    if cte:
+        query = cte + ' ' + query
+    for join in joins:
+        query = query + ' ' + join
+    if where:
+        query = query + ' WHERE ' + ' AND '.join(where)
+    if group:
+        query = query + ' GROUP BY ' + group
+    if order:
+        query = query + ' ORDER BY ' + order
+    return query
+
+
+def In(name, values):
+    """Get the placeholders & the parameters for an IN clause.
+
+    Returns a tuple with the clause (e.g. '(:project0, :project1)') & a dict
+    with the values to bind. The clause only depends on the number of values
+    so queries built with it are still cached per shape.
+    """
+    params = {}
+    for idx, value in enumerate(values):
+        params[name + str(idx)] = value
+    clause = '(' + ', '.join(':' + key for key in params) + ')'
+    return clause, params
+
+
+@lru_cache(maxsize=None)
+def RowType(fields):
+    """Get the namedtuple class for a tuple of field names."""
+    return namedtuple('Row', fields)
+
+
+def RowFactory(cursor, row):
+    """Output sqlite3 rows as namedtuples, so fields are attributes.
+
+    Set it as the row_factory of a sqlite3 connection.
+    """
+    fields = tuple(column[0] for column in cursor.description)
+    return RowType(fields)(*row)
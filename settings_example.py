@@ -19,15 +19,74 @@ class Settings(object):
 
     BACKUP_TARGET = 'path/to/backup/dir'
 
+    # Build the tarball (& dump the dbs) while the reports are shown, so the
+    # backup is ready sooner. The build is stopped & dropped if the backup is
+    # declined, but it still costs the disk & db load of the start of a
+    # backup on every run
+    BACKUP_BACKGROUND = False
+
+    # Tarball compression, 'gz', 'xz' or 'zst' (needs zstandard), & the
+    # threads to compress it (by default one per cpu)
+    BACKUP_COMPRESSION = 'gz'
+    # BACKUP_THREADS = 4
+
+    # 'incremental' tarballs only hold the files changed since the last
+    # backup, with a full one every BACKUP_FULL_EVERY backups. The manifest
+    # of the last backup is kept in home by default
+    BACKUP_MODE = 'incremental'
+    BACKUP_FULL_EVERY = 7
+    # BACKUP_MANIFEST = 'path/to/.pnr_manifest.json'
+
+    # 'tarball' or 'chunks' to keep the files deduplicated in a store (in
+    # BACKUP_TARGET/pnr-store by default), see 'pnr.py verify'
+    BACKUP_FORMAT = 'tarball'
+    # BACKUP_STORE = 'path/to/backup/dir/pnr-store'
+
+    # Load the db from the zip straight into memory (no tmp folder)
+    db_in_memory = False
+
+    # Load the work log into memory at once & answer every report from
+    # there, so a run makes no more queries (loading costs the whole history)
+    db_snapshot = False
+
+    # Run the queries with sqlite3 ('sqlite') or records ('records')
+    db_backend = 'sqlite'
+
+    # Extracted dbs are kept in a cache (by default next to the zip files)
+    # db_cache_path = 'path/to/cache/dir/'
+    db_cache_size = 512 * 1024 ** 2  # in bytes
+
+    # Daily sums kept between runs (by default in the cache folder)
+    # rollup_file = 'path/to/rollup.db'
+
+    # Threads to get the reports ready at once (1 runs them one by one)
+    report_workers = 4
+
     # Days to show on last entries summary
     last_entries_days = 3
 
     # Graph start date
     start_graph = date(2018, 1, 1)
 
+    # Save the graph to these files rather than show it (.png or .svg)
+    # graph_files = ['path/to/graph.png']
+
     # Postgres db settings
     PG_BACKUPDB = True
     PG_USER = 'postgres'
     PG_PASS = 'yourpassword'
     PG_HOST = 'localhost'
     PG_DATABASES = ['db1', 'db2', ]
+
+    # Dbs dumped at once, their format ('custom', pg_dump -Fc, or
+    # 'directory', -Fd with PG_DUMP_JOBS connections each) & the folder
+    # for the dumps (emptied on each backup, .pnr_dumps in home by default)
+    PG_WORKERS = 4
+    PG_DUMP_FORMAT = 'custom'
+    # PG_DUMP_JOBS = 2
+    # PG_DUMP_DIR = 'path/to/dumps'
+
+    # Stream custom format dumps straight into the tarball, in members of
+    # PG_PART_SIZE bytes at most (no dump files on disk)
+    PG_STREAM = True
+    # PG_PART_SIZE = 8 * 1024 ** 2
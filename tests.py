@@ -1,10 +1,37 @@
 import unittest
+from unittest import mock
 import pnr
+import query
+import benchmarks
 import os
+import io
+import random
+import gzip
+import math
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
 import records
+import numpy as np
+from collections import namedtuple
+import sqlite3
+import subprocess
+import sys
+import zipfile
 from datetime import date, datetime, timedelta
 
 
+class AlmostEqualMixin(object):
+    """Compare the hour totals, which are floats, of two reports."""
+
+    def assertDictAlmostEqual(self, first, second):
+        self.assertEqual(set(first), set(second))
+        for k in first:
+            self.assertAlmostEqual(first[k], second[k])
+
+
 class TestOrigins(unittest.TestCase):
     """Test the file and the db."""
 
@@ -31,37 +58,130 @@ class TestOrigins(unittest.TestCase):
         zipfile = path + zipfile
         self.assertTrue(os.path.isfile(zipfile))
 
-    def test_filecheck_false(self):
-        """Filecheck returns false when there's no tmp folder."""
-        filecheck = self.df.FileCheck()
-        self.assertFalse(filecheck)
-
-    def test_filecheck_folder_zipfile_false(self):
-        """Returns false when zipfile is more recent than folder."""
+    def test_getfile_ignores_names_with_zip_inside(self):
+        """Only files ending in .zip are taken into account."""
         path = self.path
-        filecheck = self.df.FileCheck()
-        os.mkdir(path + 'tmp/')
-        os.chdir(path)
-        with open('examplezip.zip', 'w'):
+        decoy = path + 'zzz_notazip.zip.txt'
+        with open(decoy, 'w'):
             pass
-        self.assertFalse(filecheck)
-        os.rmdir('tmp/')
-        os.unlink('examplezip.zip')
+        try:
+            self.assertTrue(self.df.GetFile().endswith('.zip'))
+        finally:
+            os.unlink(decoy)
+
+    def test_getfile_picks_new_zips_up(self):
+        """A new zip in the path must refresh the index."""
+        path = self.path
+        self.df.GetFile()
+        newer = path + 'zzz_newer.zip'
+        shutil.copy(path + self.df.GetFile(), newer)
+        try:
+            self.assertEqual(self.df.GetFile(), 'zzz_newer.zip')
+        finally:
+            os.unlink(newer)
+        self.assertNotEqual(self.df.GetFile(), 'zzz_newer.zip')
 
-    def test_filecheck_folder_zipfile_true(self):
-        """Returns true when folder is more recent than zipfile."""
+    def test_getfile_by_date(self):
+        """GetFile picks the last zip up to the given day."""
         path = self.path
+        older = path + 'zzz_older.zip'
+        shutil.copy(path + self.df.GetFile(), older)
+        stamp = datetime(1990, 1, 1, 12).timestamp()
+        os.utime(older, (stamp, stamp))
+        try:
+            tdb = pnr.TrackDB()
+            self.assertEqual(tdb.GetFile(date(1990, 1, 1)), 'zzz_older.zip')
+            self.assertNotEqual(tdb.GetFile(), 'zzz_older.zip')
+            with self.assertRaises(ValueError):
+                tdb.GetFile(date(1989, 12, 31))
+        finally:
+            os.unlink(older)
+
+    def test_getfile_notices_zips_replaced_in_place(self):
+        """A zip rewritten under the same name must refresh the index."""
+        path = self.path
+        latest = self.df.GetFile()
+        rotated = path + 'zzz_rotated.zip'
+        shutil.copy(path + latest, rotated)
+        try:
+            self.assertEqual(self.df.GetFile(), 'zzz_rotated.zip')
+            # Overwritten in place, the folder mtime doesn't change
+            folder = os.stat(path).st_mtime_ns
+            with open(rotated, 'r+b') as f:
+                f.write(f.read())
+            stamp = datetime(1990, 1, 1, 12).timestamp()
+            os.utime(rotated, (stamp, stamp))
+            self.assertEqual(os.stat(path).st_mtime_ns, folder)
+            self.assertEqual(self.df.GetFile(), latest)
+            self.assertEqual(pnr.TrackDB().GetFile(), latest)
+            # Renamed over, the inode changes
+            shutil.copy(path + latest, rotated + '.part')
+            os.replace(rotated + '.part', rotated)
+            self.assertEqual(self.df.GetFile(), 'zzz_rotated.zip')
+        finally:
+            os.unlink(rotated)
+        self.assertEqual(self.df.GetFile(), latest)
+
+    def test_filecheck_false(self):
+        """Filecheck returns false when the zip is not in the cache."""
+        self.df.ClearCache()
         filecheck = self.df.FileCheck()
-        os.mkdir(path + 'tmp/')
-        os.chdir(path)
         self.assertFalse(filecheck)
-        os.rmdir('tmp/')
+
+    def test_filecheck_true_once_extracted(self):
+        """Filecheck returns true after GetDB extracted the last zip."""
+        self.df.GetDB()
+        self.assertTrue(self.df.FileCheck())
+
+    def test_filecheck_newer_zipfile_false(self):
+        """Returns false when there's a newer zipfile not extracted yet."""
+        path = self.path
+        self.df.GetDB()
+        newer = path + 'zzz_newer.zip'
+        shutil.copy(path + self.df.GetFile(), newer)
+        try:
+            self.assertFalse(self.df.FileCheck())
+        finally:
+            os.unlink(newer)
+
+    def test_getdb_hits_the_cache_on_repeated_runs(self):
+        """The second GetDB on the same zip must not extract it again."""
+        self.df.GetDB()
+        before = self.df.CacheReport()
+        self.df.GetDB()
+        after = self.df.CacheReport()
+        self.assertEqual(after['hits'], before['hits'] + 1)
+        self.assertEqual(after['misses'], before['misses'])
+
+    def test_cache_keeps_the_current_version_over_the_cap(self):
+        """Eviction must never drop the version in use."""
+        dbfile = self.df.GetDB()
+        key = os.path.basename(os.path.dirname(dbfile))
+        with mock.patch.object(pnr.Settings, 'db_cache_size', 0, create=True):
+            self.df.CacheEvict(keep=key)
+        self.assertTrue(os.path.isfile(dbfile))
+        self.assertEqual(self.df.CacheReport()['versions'], 1)
 
     def test_getdb_returns_a_valid_file(self):
         """Returns true if dbfile exists."""
         dbfile = self.df.GetDB()
         self.assertTrue(os.path.isfile(dbfile))
 
+    def test_loaddb_returns_a_connection(self):
+        """The in memory db is queryable."""
+        conn = self.df.LoadDB()
+        self.assertIsInstance(conn, sqlite3.Connection)
+        count = conn.execute('SELECT count(*) FROM work').fetchone()[0]
+        self.assertGreater(count, 0)
+        conn.close()
+
+    def test_loaddb_leaves_no_tmp_folder(self):
+        """Loading into memory should not extract anything."""
+        self.df.CleanUp()
+        conn = self.df.LoadDB()
+        self.assertFalse(os.path.isdir(self.path + 'tmp/'))
+        conn.close()
+
     def test_cleanup_cleans_tmp(self):
         """Returns false if tmp folder exists after removing."""
         path = self.path
@@ -85,11 +205,67 @@ class TestData(unittest.TestCase):
         tdb = pnr.TrackDB()
         tdb.CleanUp()
 
-    def test_last_entries_outputs_a_RecordCollection(self):
-        """LastEntriesQuery() must output a class RecordCollection."""
-        today = date.today()
-        df = self.df.LastEntriesQuery(today)
-        self.assertIsInstance(df, records.RecordCollection)
+    def test_in_memory_db_gives_same_results(self):
+        """Both, extracted and in memory dbs, must output the same data."""
+        with mock.patch.object(pnr.Settings, 'db_in_memory', True,
+                               create=True):
+            df = pnr.DataYear()
+        self.assertEqual(df.Project(period='year'),
+                         self.df.Project(period='year'))
+
+    def test_deleted_entries_are_left_out(self):
+        """Entries with project <= 1 are filtered by the view."""
+        rows = self.df.db.query('SELECT count(*) AS n FROM clean_work ' +
+                                'WHERE project <= 1')
+        self.assertEqual(rows[0].n, 0)
+
+    def test_work_table_is_indexed(self):
+        """The covering indexes are created with the db."""
+        rows = self.df.db.query("SELECT name FROM sqlite_master " +
+                                "WHERE type = 'index'")
+        names = [row.name for row in rows]
+        self.assertIn('work_project_started', names)
+        self.assertIn('work_started', names)
+
+    def test_window_queries_use_an_index(self):
+        """Time windows on the raw started column hit the indexes."""
+        window = self.df.Window(date(2018, 1, 1))
+        plan = self.df.db.query('EXPLAIN QUERY PLAN SELECT ' +
+                                'sum(stopped_s - started_s) ' +
+                                'FROM clean_work AS work ' +
+                                'WHERE started >= :start AND ' +
+                                'started < :end AND project IN (19)',
+                                **window)
+        details = ' '.join(row.detail for row in plan)
+        self.assertIn('COVERING INDEX', details)
+
+    def test_window_is_half_open(self):
+        window = self.df.Window(date(2018, 3, 5), date(2018, 3, 6))
+        self.assertEqual(window, {'start': '2018-03-05', 'end': '2018-03-07'})
+
+    def test_last_entries_outputs_a_list_of_rows(self):
+        """LastEntriesQuery() outputs a list of namedtuples (sqlite)."""
+        df = self.df.LastEntriesQuery(date(2018, 3, 5))
+        self.assertIsInstance(df, list)
+        self.assertEqual(df[0]._fields, ('id', 'project', 'name', 'details',
+                                         'started', 'hour', 'lenght'))
+
+    def test_records_backend_gives_same_results(self):
+        """The records backend outputs RecordCollections with the same data."""
+        with mock.patch.object(pnr.Settings, 'db_backend', 'records',
+                               create=True):
+            df = pnr.DataYear()
+        rows = df.LastEntriesQuery(date(2018, 3, 5))
+        self.assertIsInstance(rows, records.RecordCollection)
+        self.assertEqual([tuple(row.values()) for row in rows],
+                         [tuple(row) for row in
+                          self.df.LastEntriesQuery(date(2018, 3, 5))])
+        self.assertEqual(df.Project(period='year'),
+                         self.df.Project(period='year'))
+
+    def test_queries_run_on_a_read_only_connection(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.df.db.query('DELETE FROM work')
 
     def test_last_entries_are_from_the_same_day(self):
         today = date.today()
@@ -97,6 +273,16 @@ class TestData(unittest.TestCase):
         for entry in df:
             self.assertEqual(entry.started, str(today))
 
+    def test_last_entries_range_matches_the_single_days(self):
+        """The range query groups the same entries as the per day one."""
+        start = date.today() - timedelta(days=6)
+        entries = self.df.LastEntriesRange(start, date.today())
+        for i in range(7):
+            day = start + timedelta(days=i)
+            single = [row.id for row in self.df.LastEntriesQuery(day)]
+            grouped = [row.id for row in entries.get(str(day), [])]
+            self.assertEqual(single, grouped)
+
     def test_period_year_outputs_jan_first(self):
         period_fn = self.df.Period(period='year')
         self.assertEqual(period_fn, '\'2018-01-01\'')
@@ -120,6 +306,34 @@ class TestData(unittest.TestCase):
         period_fn = self.df.Period(period='invalid period')
         self.assertEqual(period_fn, '\'2018-01-01\'')
 
+    def test_start_year_outputs_jan_first(self):
+        start_fn = self.df.Start(period='year')
+        self.assertEqual(start_fn, date(2018, 1, 1))
+
+    def test_start_week_outputs_last_monday(self):
+        start_fn = self.df.Start(period='week')
+        delta = timedelta(days=-1)
+        start = date.today()
+        while start.isocalendar()[2] != 1:  # reduce days until reach mon
+            start = start + delta
+        self.assertEqual(start_fn, start)
+
+    def test_start_custom_outputs_the_date(self):
+        custom_date = date(2018, 3, 5)
+        start_fn = self.df.Start(period=custom_date)
+        self.assertEqual(start_fn, custom_date)
+
+    def test_invalid_start_outputs_jan_first(self):
+        start_fn = self.df.Start(period='invalid period')
+        self.assertEqual(start_fn, date(2018, 1, 1))
+
+    def test_tagday_binds_the_tag_name(self):
+        """Tag names are bound, so quotes in them can't break the query."""
+        start = date(2018, 1, 1)
+        daylist = pnr.Graph().DayList()
+        tag_day = self.df.TagDay(start, 'it\'s; no tag', daylist)
+        self.assertEqual(set(tag_day), {0})
+
     def test_tags_outputs_a_dict_element(self):
         tags = self.df.Tags(period='year')
         self.assertIsInstance(tags, dict)
@@ -173,6 +387,36 @@ class TestData(unittest.TestCase):
         for item in project_day:
             self.assertIsInstance(item, int)
 
+    def test_dailyseries_aligns_rows_with_the_days(self):
+        """Days with no row (or an ongoing one) get the fill value."""
+        Row = namedtuple('Row', 'date lenght')
+        data = [Row('2018-01-01', 10), Row('2018-01-03', None),
+                Row('2018-01-04', 30)]
+        day_list = [date(2018, 1, i) for i in range(1, 5)]
+        series = self.df.DailySeries(data, day_list, fill=-1)
+        self.assertEqual(series, [10, -1, -1, 30])
+
+    def test_seriesday_matches_the_single_series(self):
+        """The batched query outputs the same as one query per series."""
+        start = date(2018, 1, 1)
+        daylist = pnr.Graph().DayList()
+        specs = [('awake', ), ('project', 19), ('tag', 'BuildUp'),
+                 ('project', (26, 27, 28, 29, 30))]
+        awake, math, bu, opk = self.df.SeriesDay(start, specs, daylist)
+        self.assertEqual(awake, self.df.AwakeDay(start, daylist))
+        self.assertEqual(math, self.df.ProjectDay(start, 19, daylist))
+        self.assertEqual(bu, self.df.TagDay(start, 'BuildUp', daylist))
+        self.assertEqual(opk, self.df.ProjectDay(start, (26, 27, 28, 29, 30),
+                                                 daylist))
+
+    def test_seriesday_raises_error_on_unknown_series(self):
+        start = date(2018, 1, 1)
+        daylist = pnr.Graph().DayList()
+        with self.assertRaises(ValueError):
+            self.df.SeriesDay(start, [('label', 'BuildUp')], daylist)
+        with self.assertRaises(TypeError):
+            self.df.SeriesDay(start, [('project', '38')], daylist)
+
     def test_projectday_raises_error_on_wrong_date(self):
         start = 'date'
         graph = pnr.Graph()
@@ -190,6 +434,1069 @@ class TestData(unittest.TestCase):
             project_day = self.df.ProjectDay(start, ('38', 12, 'abc'), daylist)
 
 
+class TestWorkLog(AlmostEqualMixin, unittest.TestCase):
+    """Test the in-memory snapshot against the db queries."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Load both, the snapshot & the plain db."""
+        cls.df = pnr.DataYear()
+        cls.log = pnr.WorkLog()
+
+    @classmethod
+    def tearDownClass(cls):
+        tdb = pnr.TrackDB()
+        tdb.CleanUp()
+
+    def test_tags_match_the_db(self):
+        for period in ('year', 'week', date(2018, 5, 1)):
+            self.assertDictAlmostEqual(self.log.Tags(period),
+                                       self.df.Tags(period))
+
+    def test_project_match_the_db(self):
+        for period in ('year', 'week'):
+            self.assertDictAlmostEqual(self.log.Project(period),
+                                       self.df.Project(period))
+
+    def test_quality_sleep_matches_the_db(self):
+        self.assertDictAlmostEqual(self.log.QualitySleep(),
+                                   self.df.QualitySleep())
+
+    def test_last_entries_match_the_db(self):
+        start = date.today() - timedelta(days=3)
+        entries = self.log.LastEntriesRange(start, date.today())
+        expected = self.df.LastEntriesRange(start, date.today())
+        self.assertEqual(set(entries), set(expected))
+        for day in expected:
+            for entry, row in zip(entries[day], expected[day]):
+                self.assertEqual(tuple(entry), tuple(row))
+
+    def test_seriesday_matches_the_db(self):
+        start = date(2018, 1, 1)
+        daylist = pnr.Graph().DayList()
+        specs = [('awake', ), ('project', 19), ('tag', 'BuildUp'),
+                 ('project', (26, 27, 28, 29, 30)), ('tag', 'no tag')]
+        self.assertEqual(self.log.SeriesDay(start, specs, daylist),
+                         self.df.SeriesDay(start, specs, daylist))
+
+    def test_projectday_items_are_integers(self):
+        start = date(2018, 1, 1)
+        daylist = pnr.Graph().DayList()
+        for item in self.log.ProjectDay(start, 38, daylist):
+            self.assertIsInstance(item, int)
+
+    def test_no_queries_once_loaded(self):
+        """The reports must not hit the db anymore."""
+        start = date(2018, 1, 1)
+        daylist = pnr.Graph().DayList()
+        with mock.patch.object(self.log, 'Query', side_effect=AssertionError):
+            self.log.Tags('year')
+            self.log.Project('week')
+            self.log.QualitySleep()
+            self.log.LastEntriesRange(start, date.today())
+            self.log.SeriesDay(start, [('awake', ), ('tag', 'BuildUp')],
+                               daylist)
+
+
+class TestRollup(AlmostEqualMixin, unittest.TestCase):
+    """Test the daily sums kept between runs."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Build a rollup from scratch in a tmp folder."""
+        cls.df = pnr.DataYear()
+        cls.tmp = tempfile.mkdtemp()
+        cls.rollup = pnr.Rollup(cls.df, path=cls.tmp + '/rollup.db')
+        cls.rollup.Update()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+        tdb = pnr.TrackDB()
+        tdb.CleanUp()
+
+    def assertMatchesTheDb(self):
+        for period in ('year', 'week', date(2018, 5, 1)):
+            self.assertDictAlmostEqual(self.rollup.Tags(period),
+                                       self.df.Tags(period))
+            self.assertDictAlmostEqual(self.rollup.Project(period),
+                                       self.df.Project(period))
+        start = date(2018, 1, 1)
+        daylist = pnr.Graph().DayList()
+        specs = [('awake', ), ('project', 19), ('tag', 'BuildUp'),
+                 ('project', (26, 27, 28, 29, 30))]
+        self.assertEqual(self.rollup.SeriesDay(start, specs, daylist),
+                         self.df.SeriesDay(start, specs, daylist))
+
+    def test_rollup_matches_the_db(self):
+        self.assertMatchesTheDb()
+
+    def test_seriesday_is_a_single_query(self):
+        start = date(2018, 1, 1)
+        daylist = pnr.Graph().DayList()
+        specs = [('awake', ), ('project', 19), ('tag', 'BuildUp'),
+                 ('tag', 'no tag'), ('project', (26, 27))]
+        with mock.patch.object(self.rollup, 'Execute',
+                               wraps=self.rollup.Execute) as execute:
+            series = self.rollup.SeriesDay(start, specs, daylist)
+        self.assertEqual(execute.call_count, 1)
+        self.assertEqual(series, self.df.SeriesDay(start, specs, daylist))
+        self.assertEqual(self.rollup.SeriesDay(start, [], daylist), [])
+
+    def test_worklog_builds_the_same_rollup(self):
+        log = pnr.WorkLog()
+        rollup = pnr.Rollup(log, path=self.tmp + '/rollup_log.db')
+        rollup.Update()
+        query = 'SELECT * FROM %s ORDER BY 1, 2'
+        for table in ('project_day', 'tag_day'):
+            expected = self.rollup.conn.execute(query % table).fetchall()
+            self.assertEqual(rollup.conn.execute(query % table).fetchall(),
+                             expected)
+
+    def test_update_only_adds_up_the_last_days(self):
+        since = self.rollup.Update()
+        self.assertEqual(since, self.rollup.Meta()['keep'])
+        self.assertGreater(since, '2018-01-01')
+        self.assertMatchesTheDb()
+
+    def test_update_picks_new_entries_up(self):
+        """Entries with ids over the last seen are added up again."""
+        last_id = self.rollup.Meta()['last_id']
+        with self.rollup.conn:
+            self.rollup.conn.execute("UPDATE meta SET value = ? " +
+                                     "WHERE key = 'last_id'", (last_id - 50, ))
+        since = self.rollup.Update()
+        self.assertLess(since, self.rollup.Meta()['keep'])
+        self.assertMatchesTheDb()
+
+    def test_other_db_rebuilds_the_rollup(self):
+        with self.rollup.conn:
+            self.rollup.conn.execute("UPDATE meta SET value = 1000000000 " +
+                                     "WHERE key = 'last_id'")
+        self.assertEqual(self.rollup.Update(), str(date.min))
+        self.assertMatchesTheDb()
+
+    def test_totals_match_the_db_for_any_period(self):
+        for days in (0, 1, 6, 30, 200, 5000):
+            start = date.today() - timedelta(days=days)
+            self.assertDictAlmostEqual(self.rollup.Tags(start),
+                                       self.df.Tags(start))
+            self.assertDictAlmostEqual(self.rollup.Project(start),
+                                       self.df.Project(start))
+
+    def test_totals_of_a_closed_window(self):
+        start, end = date(2018, 3, 1), date(2018, 3, 31)
+        totals = self.rollup.Totals('project_day', start, end)
+        expected = (self.df.Project(start),
+                    self.df.Project(end + timedelta(1)))
+        for name in totals:
+            hours = expected[0][name] - expected[1].get(name, 0)
+            self.assertAlmostEqual(totals[name] / 3600, hours)
+
+    def test_totals_need_no_queries(self):
+        self.rollup.Tags('year')
+        self.rollup.Project('year')
+        with mock.patch.object(self.rollup, 'conn'):
+            self.rollup.conn.execute.side_effect = AssertionError
+            self.rollup.Tags(date(2018, 5, 1))
+            self.rollup.Project('week')
+
+    def test_other_queries_are_passed_on_to_the_db(self):
+        self.assertEqual(self.rollup.QualitySleep(), self.df.QualitySleep())
+
+
+class TestSplit(unittest.TestCase):
+    """Test the entries crossing midnight & the start of the periods."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Zip a tiny db with a night sleep & a work across monday."""
+        cls.tmp = tempfile.mkdtemp()
+        conn = sqlite3.connect(cls.tmp + '/tracker.db')
+        conn.executescript("""
+            CREATE TABLE work (id INTEGER PRIMARY KEY, project INTEGER,
+                project_name TEXT, details TEXT, started TEXT, stopped TEXT);
+            CREATE TABLE tag (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE work_tag (work_id INTEGER, tag_id INTEGER);
+            INSERT INTO tag VALUES (1, 'BuildUp');
+            INSERT INTO work VALUES
+                (1, 38, 'Shift.Sleep', NULL, '2018-03-04 23:00:00',
+                 '2018-03-05 07:00:00'),
+                (2, 19, 'BuildUp.Math', NULL, '2018-03-11 22:00:00',
+                 '2018-03-12 02:00:00');
+            INSERT INTO work_tag VALUES (2, 1);
+            """)
+        conn.commit()
+        conn.close()
+        with zipfile.ZipFile(cls.tmp + '/backup.zip', 'w') as zip_file:
+            zip_file.write(cls.tmp + '/tracker.db', 'tracker.db')
+        os.unlink(cls.tmp + '/tracker.db')
+        with mock.patch.object(pnr.Settings, 'db_file', cls.tmp + '/'):
+            cls.df = pnr.DataYear()
+            cls.log = pnr.WorkLog()
+        cls.rollup = pnr.Rollup(cls.df, path=cls.tmp + '/rollup.db')
+        cls.rollup.Update()
+        cls.dbs = (cls.df, cls.log, cls.rollup)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def test_awake_time_is_split_at_midnight(self):
+        daylist = [date(2018, 3, 4), date(2018, 3, 5)]
+        for db in self.dbs:
+            self.assertEqual(db.AwakeDay(daylist[0], daylist),
+                             [86400 - 3600, 86400 - 7 * 3600])
+
+    def test_tagday_is_split_at_midnight(self):
+        daylist = [date(2018, 3, 11), date(2018, 3, 12), date(2018, 3, 13)]
+        for db in self.dbs:
+            self.assertEqual(db.TagDay(daylist[0], 'BuildUp', daylist),
+                             [7200, 7200, 0])
+
+    def test_periods_only_count_from_their_start(self):
+        monday = date(2018, 3, 12)
+        for db in self.dbs:
+            self.assertEqual(db.Project(monday), {'BuildUp.Math': 2.0})
+            self.assertEqual(db.Tags(monday), {'BuildUp': 2.0})
+            self.assertEqual(db.Project(date(2018, 3, 5)),
+                             {'Shift.Sleep': 7.0, 'BuildUp.Math': 4.0})
+
+    def test_worklog_makes_the_same_daily_totals(self):
+        since = date(2018, 3, 5)
+        self.assertEqual(self.log.DailyTotals(since),
+                         self.df.DailyTotals(since))
+
+
+class TestRollupChecks(unittest.TestCase):
+    """Test that old entries deleted or edited get to the rollup."""
+
+    TRACKER = """
+        CREATE TABLE work (id INTEGER PRIMARY KEY, project INTEGER,
+            project_name TEXT, details TEXT, started TEXT, stopped TEXT);
+        CREATE TABLE tag (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE work_tag (work_id INTEGER, tag_id INTEGER);
+        INSERT INTO tag VALUES (1, 'BuildUp'), (2, 'Other');
+        INSERT INTO work VALUES
+            (1, 19, 'BuildUp.Math', NULL, '2018-03-05 10:00:00',
+             '2018-03-05 12:00:00'),
+            (2, 19, 'BuildUp.Math', NULL, '2018-03-05 14:00:00',
+             '2018-03-05 15:00:00'),
+            (3, 20, 'BuildUp.Code', NULL, '2018-03-20 10:00:00',
+             '2018-03-20 11:00:00');
+        INSERT INTO work_tag VALUES (1, 1), (2, 1);
+        """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch.object(pnr.Settings, 'db_file', self.tmp + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.path = self.tmp + '/rollup.db'
+        self.Zip(1, '')
+        pnr.Rollup(pnr.DataYear(), path=self.path).Update()
+
+    def Zip(self, idx, changes):
+        """Zip the tracker db with some changes, newer than the former."""
+        tracker = '%s/tracker%s.db' % (self.tmp, idx)
+        conn = sqlite3.connect(tracker)
+        conn.executescript(self.TRACKER + changes)
+        conn.commit()
+        conn.close()
+        zip_name = '%s/backup%s.zip' % (self.tmp, idx)
+        with zipfile.ZipFile(zip_name, 'w') as zip_file:
+            zip_file.write(tracker, 'tracker.db')
+        os.unlink(tracker)
+        os.utime(zip_name, (1000000 + idx, 1000000 + idx))
+
+    def Updated(self, changes):
+        """Update the rollup from a db with some changes.
+
+        Returns the rollup & a DataYear on the db.
+        """
+        self.Zip(2, changes)
+        df = pnr.DataYear()
+        rollup = pnr.Rollup(df, path=self.path)
+        self.assertEqual(rollup.Update(), '2018-03-05')
+        return rollup, df
+
+    def assertMatchesTheDb(self, rollup, df):
+        for period in ('year', date(2018, 3, 6)):
+            self.assertEqual(rollup.Project(period), df.Project(period))
+            self.assertEqual(rollup.Tags(period), df.Tags(period))
+
+    def test_deleted_entries_are_taken_out(self):
+        rollup, df = self.Updated('UPDATE work SET project = 1 WHERE id = 1;')
+        self.assertEqual(rollup.Project('year'),
+                         {'BuildUp.Math': 1.0, 'BuildUp.Code': 1.0})
+        self.assertMatchesTheDb(rollup, df)
+
+    def test_edited_entries_are_added_up_again(self):
+        rollup, df = self.Updated("""
+            UPDATE work SET stopped = '2018-03-05 13:00:00' WHERE id = 1;
+            UPDATE work_tag SET tag_id = 2 WHERE work_id = 2;
+            """)
+        self.assertEqual(rollup.Tags('year'), {'BuildUp': 3.0, 'Other': 1.0})
+        self.assertMatchesTheDb(rollup, df)
+
+    def test_worklog_makes_the_same_checks(self):
+        self.Zip(2, 'UPDATE work SET project = 1 WHERE id = 3;')
+        self.assertEqual(pnr.WorkLog().DayChecks(),
+                         pnr.DataYear().DayChecks())
+
+    def test_unchanged_days_are_kept(self):
+        self.Zip(2, '')
+        rollup = pnr.Rollup(pnr.DataYear(), path=self.path)
+        self.assertEqual(rollup.Update(), '2018-03-20')
+
+    def test_rebuild_flag(self):
+        rollup = pnr.Rollup(pnr.DataYear(), path=self.path)
+        with mock.patch.object(pnr.Settings, 'rebuild', True, create=True):
+            self.assertEqual(rollup.Refresh(), str(date.min))
+        self.assertEqual(rollup.Refresh(), '2018-03-20')
+
+
+class TestGraph(unittest.TestCase):
+    """Test the data preparation for the graph."""
+
+    def setUp(self):
+        self.graph = pnr.Graph()
+
+    def test_aggregation_outputs_the_running_sum(self):
+        agg = self.graph.Aggregation([1, 2, 3, 4])
+        self.assertEqual(list(agg), [1, 3, 6, 10])
+
+    def test_aggregation_raises_error_on_wrong_values(self):
+        with self.assertRaises(TypeError):
+            self.graph.Aggregation((1, 2, 3))
+
+    def test_ratio_with_repeated_values(self):
+        """Equal values in over must keep their own position."""
+        ratio = self.graph.Ratio([1, 1, 2], [2, 4, 4])
+        self.assertEqual(list(ratio), [50, 25, 50])
+
+    def test_ratio_over_zero_is_nan(self):
+        ratio = self.graph.Ratio([1, 2], [0, 4])
+        self.assertTrue(math.isnan(ratio[0]))
+        self.assertEqual(ratio[1], 50)
+
+    def test_ratio_raises_error_on_different_lenghts(self):
+        with self.assertRaises(ValueError):
+            self.graph.Ratio([1, 2], [1])
+
+    def test_preparedata_drops_the_last_day(self):
+        prepared = self.graph.PrepareData([3600, 3600, 0], [7200] * 3, 'x')
+        self.assertEqual(prepared['label'], 'x')
+        self.assertEqual(list(prepared['data']), [50, 50])
+
+    def test_render_saves_the_files_with_the_same_figure(self):
+        data = [self.graph.PrepareData(list(range(30)), [100] * 30, str(i))
+                for i in range(4)]
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        files = [tmp + '/graph.png', tmp + '/graph.svg']
+        self.assertEqual(self.graph.Render(data, files), files)
+        figure = self.graph.figure
+        self.graph.Render(data, files[:1])
+        self.assertIs(self.graph.figure, figure)
+        self.assertEqual(len(figure.axes), 4)
+        for name in files:
+            self.assertGreater(os.path.getsize(name), 0)
+
+    def test_matplotlib_is_not_imported_on_start(self):
+        check = 'import sys, pnr; print("matplotlib" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', check])
+        self.assertEqual(output.strip(), b'False')
+
+
+class TestStartup(unittest.TestCase):
+    """Test the dependencies are only loaded on first use."""
+
+    def test_heavy_modules_are_not_imported_on_start(self):
+        check = ('import sys, pnr; print(sorted(set(sys.modules) & ' +
+                 '{"records", "sqlalchemy", "numpy", "sh", "tarfile", ' +
+                 '"zipfile", "matplotlib", "docopt"}))')
+        output = subprocess.check_output([sys.executable, '-c', check])
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_parse_import_time(self):
+        output = ('import time: self [us] | cumulative | imported package\n' +
+                  'import time:       100 |        100 |   json.decoder\n' +
+                  'import time:       200 |        300 | json\n' +
+                  'import time:        50 |         50 | pnr\n')
+        total, top = benchmarks.ParseImportTime(output)
+        self.assertAlmostEqual(total, 350 / 10 ** 6)
+        self.assertEqual(top, {'json': 300 / 10 ** 6, 'pnr': 50 / 10 ** 6})
+
+
+class TestQuery(unittest.TestCase):
+    """Test the query builder."""
+
+    def test_select_returns_the_same_text_for_the_same_shape(self):
+        fields = (('sum(%s)' % query.LENGHT, 'lenght'), ('tag.name', 'tag'))
+        first = query.Select(fields, joins=query.TAG_JOINS,
+                             where=(query.WINDOW, ), group='tag')
+        second = query.Select(fields, joins=query.TAG_JOINS,
+                              where=(query.WINDOW, ), group='tag')
+        self.assertIs(first, second)
+        self.assertTrue(first.startswith('SELECT sum(stopped_s - started_s)'))
+
+    def test_in_outputs_placeholders_and_params(self):
+        clause, params = query.In('project', (26, 27))
+        self.assertEqual(clause, '(:project0, :project1)')
+        self.assertEqual(params, {'project0': 26, 'project1': 27})
+
+
+class TestSession(unittest.TestCase):
+    """Test the db session shared by the reports."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Open a single session for all the reports."""
+        cls.db = pnr.DataYear()
+
+    @classmethod
+    def tearDownClass(cls):
+        tdb = pnr.TrackDB()
+        tdb.CleanUp()
+
+    def test_reports_keep_the_given_session(self):
+        """Reports must not open their own db when one is given."""
+        self.assertIs(pnr.LastEntries(self.db).db, self.db)
+        self.assertIs(pnr.Graph(self.db).db, self.db)
+
+    def test_last_entries_dataframe_uses_the_session(self):
+        last_entries = pnr.LastEntries(self.db)
+        df = last_entries.DataFrame()
+        self.assertIs(last_entries.db, self.db)
+        self.assertEqual(len(df), last_entries.days)
+
+
+class TestPipeline(unittest.TestCase):
+    """Test the reports computed at once."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Share the db & a rollup between the reports, as Menu does."""
+        cls.db = pnr.DataYear()
+        cls.tmp = tempfile.mkdtemp()
+        cls.rollup = pnr.Rollup(cls.db, path=cls.tmp + '/rollup.db')
+        cls.rollup.Update()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+        tdb = pnr.TrackDB()
+        tdb.CleanUp()
+
+    def test_results_keep_the_order_of_the_jobs(self):
+        jobs = [lambda i=i: i for i in range(10)]
+        self.assertEqual(pnr.Pipeline(jobs, workers=4).Run(), list(range(10)))
+        self.assertEqual(pnr.Pipeline(jobs, workers=1).Run(), list(range(10)))
+
+    def test_concurrent_reports_match_the_sequential_ones(self):
+        jobs = [lambda: pnr.LastEntries(self.db).Fetch(),
+                lambda: pnr.Week(self.rollup),
+                lambda: pnr.Year(self.rollup),
+                lambda: pnr.Graph(self.rollup).Fetch()]
+        first = pnr.Pipeline(jobs, workers=1).Run()
+        self.rollup.prefix = {}
+        second = pnr.Pipeline(jobs, workers=4).Run()
+        self.assertEqual(first[0].df, second[0].df)
+        for idx in (1, 2):
+            self.assertEqual(first[idx].tag_times, second[idx].tag_times)
+            self.assertEqual(first[idx].project_times,
+                             second[idx].project_times)
+        for one, other in zip(first[3].to_plot, second[3].to_plot):
+            self.assertTrue(np.array_equal(one['data'], other['data'],
+                                           equal_nan=True))
+
+
+# Dumps its arguments (to -f or stdout, after $PG_PAD x's) after $PG_SLEEP
+# seconds & logs when it starts & stops, the db named fail fails
+FAKE_PG_DUMP = """#!/bin/sh
+echo start >> "$PG_LOG"
+args="$*"
+sleep "${PG_SLEEP:-0.3}"
+out=/dev/stdout
+while [ $# -gt 1 ]; do
+    if [ "$1" = -f ]; then out=$2; fi
+    shift
+done
+if [ "$1" = fail ]; then exit 1; fi
+case "$args" in *-Fd*) mkdir -p "$out"; out="$out/toc.dat";; esac
+(head -c "${PG_PAD:-0}" /dev/zero | tr '\\0' x; echo "$args") > "$out"
+echo stop >> "$PG_LOG"
+"""
+
+
+def FakePgDump(test):
+    """Put a fake pg_dump in the PATH for a test, returns its log path."""
+    folder = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, folder)
+    with open(os.path.join(folder, 'pg_dump'), 'w') as f:
+        f.write(FAKE_PG_DUMP)
+    os.chmod(os.path.join(folder, 'pg_dump'), 0o755)
+    log = os.path.join(folder, 'log')
+    patcher = mock.patch.dict(os.environ, PG_LOG=log,
+                              PATH=folder + os.pathsep + os.environ['PATH'])
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return log
+
+
+class TestCompress(unittest.TestCase):
+    """Test the tarball building."""
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp() + '/'
+        os.mkdir(self.home + 'dir1')
+        with open(self.home + 'dir1/file', 'w') as f:
+            f.write('data')
+        patcher = mock.patch.multiple(pnr.Settings, home=self.home,
+                                      BACKUP_FOLDERS=['dir1'],
+                                      BACKUP_FILES=['missing'],
+                                      PG_BACKUPDB=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.home)
+
+    def test_build_asks_nothing(self):
+        compress = pnr.Compress(quiet=True)
+        cwd = os.getcwd()
+        with mock.patch('builtins.input', side_effect=AssertionError):
+            name = compress.Build()
+        self.assertEqual(os.getcwd(), cwd)
+        with tarfile.open(self.home + name) as tar:
+            self.assertEqual(tar.getnames(), [pnr.Compress.MANIFEST, 'dir1',
+                                              'dir1/file'])
+        # start, missing file & the summary
+        self.assertEqual(len(compress.messages), 3)
+
+    def test_discard_removes_the_tarball(self):
+        compress = pnr.Compress(quiet=True)
+        name = compress.Build()
+        compress.Discard(name)
+        self.assertFalse(os.path.exists(self.home + name))
+
+    def Backup(self):
+        """Build a tarball & keep its manifest as Finish does."""
+        compress = pnr.Compress(quiet=True)
+        name = compress.Build()
+        compress.SaveManifest(compress.manifest)
+        return name, compress.manifest
+
+    def test_incremental_only_takes_the_changes(self):
+        with open(self.home + 'dir1/other', 'w') as f:
+            f.write('other')
+        full, manifest = self.Backup()
+        self.assertEqual(manifest['kind'], 'full')
+        with open(self.home + 'dir1/file', 'w') as f:
+            f.write('changed')
+        os.remove(self.home + 'dir1/other')
+        name, manifest = self.Backup()
+        self.assertEqual(manifest['kind'], 'incremental')
+        self.assertEqual(manifest['base'], full)
+        self.assertEqual(manifest['added'], ['dir1/file'])
+        self.assertEqual(manifest['deleted'], ['dir1/other'])
+        with tarfile.open(self.home + name) as tar:
+            self.assertEqual(tar.getnames(), [pnr.Compress.MANIFEST,
+                                              'dir1/file'])
+
+    def test_incremental_takes_folders_out_of_home(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        with open(os.path.join(outside, 'f'), 'w') as f:
+            f.write('out')
+        arcname = os.path.join(outside, 'f').lstrip('/')
+        with mock.patch.object(pnr.Settings, 'BACKUP_FOLDERS',
+                               ['dir1', outside]):
+            full, manifest = self.Backup()
+            self.assertIn(arcname, manifest['files'])
+            with open(os.path.join(outside, 'f'), 'w') as f:
+                f.write('changed')
+            name, manifest = self.Backup()
+        self.assertEqual(manifest['added'], [arcname])
+        with tarfile.open(self.home + name) as tar:
+            self.assertEqual(tar.extractfile(arcname).read(), b'changed')
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        restored = pnr.Compress(quiet=True).Restore(target, name,
+                                                    folder=self.home)
+        self.assertEqual(sorted(restored), sorted([arcname, 'dir1/file']))
+
+    def test_links_are_kept_and_special_files_skipped(self):
+        os.symlink('nowhere', self.home + 'dir1/dangling')
+        os.symlink('file', self.home + 'dir1/link')
+        os.mkdir(self.home + 'dir1/sub')
+        os.symlink('sub', self.home + 'dir1/sublink')
+        os.mkfifo(self.home + 'dir1/fifo')
+        full, manifest = self.Backup()
+        files = ['dir1/dangling', 'dir1/file', 'dir1/link', 'dir1/sublink']
+        self.assertEqual(sorted(manifest['files']), files)
+        os.remove(self.home + 'dir1/link')
+        os.symlink('nowhere', self.home + 'dir1/link')
+        name, manifest = self.Backup()
+        self.assertEqual(manifest['added'], ['dir1/link'])
+        for tarball in (full, name):
+            with tarfile.open(self.home + tarball) as tar:
+                self.assertNotIn('dir1/fifo', tar.getnames())
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        restored = pnr.Compress(quiet=True).Restore(target, name,
+                                                    folder=self.home)
+        self.assertEqual(sorted(restored), files)
+        self.assertEqual(os.readlink(target + '/dir1/link'), 'nowhere')
+        self.assertEqual(os.readlink(target + '/dir1/sublink'), 'sub')
+
+    def test_restore_an_unknown_point(self):
+        self.Backup()
+        with self.assertRaises(ValueError):
+            pnr.Compress(quiet=True).Restore(self.home + 'target', 'nope',
+                                             folder=self.home)
+
+    def test_full_every_n_backups(self):
+        with mock.patch.object(pnr.Settings, 'BACKUP_FULL_EVERY', 2,
+                               create=True):
+            kinds = [self.Backup()[1]['kind'] for idx in range(3)]
+        self.assertEqual(kinds, ['full', 'incremental', 'full'])
+
+    def test_restore_a_point_in_time(self):
+        with open(self.home + 'dir1/other', 'w') as f:
+            f.write('other')
+        first, manifest = self.Backup()
+        time.sleep(1)  # names have a second resolution
+        with open(self.home + 'dir1/file', 'w') as f:
+            f.write('changed')
+        os.remove(self.home + 'dir1/other')
+        for compression in ('gz', 'xz'):
+            with mock.patch.object(pnr.Settings, 'BACKUP_COMPRESSION',
+                                   compression, create=True):
+                second, manifest = self.Backup()
+            target = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, target)
+            compress = pnr.Compress(quiet=True)
+            restored = compress.Restore(target, folder=self.home)
+            self.assertEqual(restored, ['dir1/file'])
+            with open(os.path.join(target, 'dir1/file')) as f:
+                self.assertEqual(f.read(), 'changed')
+            self.assertFalse(os.path.exists(os.path.join(target,
+                                                         'dir1/other')))
+            os.remove(self.home + second)
+            compress.SaveManifest(compress.Backups(self.home)[first])
+
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        restored = compress.Restore(target, first, folder=self.home)
+        self.assertEqual(sorted(restored), ['dir1/file', 'dir1/other'])
+
+    def test_dumps_run_at_once(self):
+        log = FakePgDump(self)
+        with mock.patch.multiple(pnr.Settings, create=True, PG_BACKUPDB=True,
+                                 PG_DATABASES=['a', 'b', 'c'], PG_WORKERS=2,
+                                 PG_USER='u', PG_PASS='p', PG_HOST='h'):
+            name = pnr.Compress(quiet=True).Build()
+        with tarfile.open(self.home + name) as tar:
+            self.assertEqual(sorted(tar.getnames()[-3:]),
+                             ['a.dump', 'b.dump', 'c.dump'])
+            dump = tar.extractfile('b.dump').read().decode()
+        self.assertEqual(dump, '-h h -U u -Fc b\n')
+        running, most = 0, 0
+        with open(log) as f:
+            for line in f:
+                running += 1 if line == 'start\n' else -1
+                most = max(most, running)
+        self.assertEqual(most, 2)
+
+    def test_dumps_are_streamed_in_parts(self):
+        FakePgDump(self)
+        with mock.patch.multiple(pnr.Settings, create=True, PG_BACKUPDB=True,
+                                 PG_DATABASES=['a', 'b'], PG_PART_SIZE=8,
+                                 PG_USER='u', PG_PASS='p', PG_HOST='h'):
+            name = pnr.Compress(quiet=True).Build()
+        self.assertFalse(os.path.exists(self.home + '.pnr_dumps'))
+        with tarfile.open(self.home + name) as tar:
+            names = [member for member in tar.getnames()
+                     if member.startswith('a.')]
+        # '-h h -U u -Fc a\n' is 16 bytes
+        self.assertEqual(names, ['a.dump.part000', 'a.dump.part001'])
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        pnr.Compress(quiet=True).Restore(target, folder=self.home)
+        with open(os.path.join(target, 'a.dump')) as f:
+            self.assertEqual(f.read(), '-h h -U u -Fc a\n')
+
+    def test_dumps_with_over_a_thousand_parts(self):
+        FakePgDump(self)
+        with mock.patch.multiple(pnr.Settings, create=True, PG_BACKUPDB=True,
+                                 PG_DATABASES=['a'], PG_PART_SIZE=1,
+                                 PG_USER='u', PG_PASS='p', PG_HOST='h'):
+            with mock.patch.dict(os.environ, PG_PAD='1500'):
+                name = pnr.Compress(quiet=True).Build()
+        expected = 'x' * 1500 + '-h h -U u -Fc a\n'
+        with tarfile.open(self.home + name) as tar:
+            self.assertIn('a.dump.part%s' % (len(expected) - 1),
+                          tar.getnames())
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        pnr.Compress(quiet=True).Restore(target, folder=self.home)
+        self.assertEqual(sorted(os.listdir(target)), ['a.dump', 'dir1'])
+        with open(os.path.join(target, 'a.dump')) as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_failed_dumps_fail_the_build(self):
+        FakePgDump(self)
+        with mock.patch.multiple(pnr.Settings, create=True, PG_BACKUPDB=True,
+                                 PG_DATABASES=['a', 'fail'], PG_USER='u',
+                                 PG_PASS='p', PG_HOST='h'):
+            with self.assertRaises(subprocess.CalledProcessError):
+                pnr.Compress(quiet=True).Build()
+        self.assertEqual([name for name in os.listdir(self.home)
+                          if '.tar.' in name], [])
+
+    def assertCancelStopsTheBuild(self, **settings):
+        FakePgDump(self)
+        compress = pnr.Compress(quiet=True)
+        timer = threading.Timer(0.5, compress.Cancel)
+        start = time.time()
+        with mock.patch.multiple(pnr.Settings, create=True, PG_BACKUPDB=True,
+                                 PG_DATABASES=['a', 'b'], PG_USER='u',
+                                 PG_PASS='p', PG_HOST='h', **settings):
+            with mock.patch.dict(os.environ, PG_SLEEP='30'):
+                timer.start()
+                with self.assertRaises(pnr.Cancelled):
+                    compress.Build()
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(sorted(os.listdir(self.home)), ['dir1'])
+
+    def test_cancel_stops_streamed_dumps(self):
+        self.assertCancelStopsTheBuild()
+
+    def test_cancel_stops_dumps_to_files(self):
+        self.assertCancelStopsTheBuild(PG_STREAM=False)
+
+    def Menu(self, answer):
+        """Run the menu on mocked reports, building the backup meanwhile."""
+        settings = {'BACKUP_BACKGROUND': True, 'answers': {'backup': answer},
+                    'batch': True}
+        with mock.patch.multiple(pnr, DataYear=mock.DEFAULT,
+                                 Rollup=mock.DEFAULT, Pipeline=mock.DEFAULT):
+            with mock.patch.object(pnr.TrackDB, 'CleanUp'):
+                with mock.patch.multiple(pnr.Settings, create=True,
+                                         **settings):
+                    pnr.Menu()
+
+    def test_declined_backup_is_stopped(self):
+        FakePgDump(self)
+        start = time.time()
+        with mock.patch.multiple(pnr.Settings, create=True, PG_BACKUPDB=True,
+                                 PG_DATABASES=['a'], PG_USER='u',
+                                 PG_PASS='p', PG_HOST='h'):
+            with mock.patch.dict(os.environ, PG_SLEEP='30'):
+                self.Menu('')
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(sorted(os.listdir(self.home)), ['dir1'])
+
+    def test_declined_backup_errors_are_told(self):
+        with mock.patch.object(pnr.Compress, 'Build',
+                               side_effect=ValueError('boom')):
+            with mock.patch('builtins.print') as print_:
+                self.Menu('')
+        print_.assert_called_with('Warning: the backup failed (boom)')
+
+    def test_directory_dumps(self):
+        FakePgDump(self)
+        with mock.patch.multiple(pnr.Settings, create=True, PG_BACKUPDB=True,
+                                 PG_DATABASES=['a'], PG_USER='u',
+                                 PG_PASS='p', PG_HOST='h',
+                                 PG_DUMP_FORMAT='directory'):
+            name = pnr.Compress(quiet=True).Build()
+        with tarfile.open(self.home + name) as tar:
+            dump = tar.extractfile('a.dir/toc.dat').read().decode()
+        self.assertIn('-Fd -j 2', dump)
+
+    def assertTarballHoldsTheData(self, name, mode):
+        with tarfile.open(self.home + name, mode) as tar:
+            data = tar.extractfile('dir1/data').read()
+        self.assertEqual(data, self.data)
+
+    def test_parallel_blocks_are_still_one_file(self):
+        """Each block is a member, but the tarball reads as usual."""
+        self.data = os.urandom(5000) * 4
+        with open(self.home + 'dir1/data', 'wb') as f:
+            f.write(self.data)
+        for compression, mode in (('gz', 'r:gz'), ('xz', 'r:xz')):
+            with mock.patch.multiple(pnr.Settings, create=True,
+                                     BACKUP_COMPRESSION=compression,
+                                     BACKUP_THREADS=4,
+                                     BACKUP_BLOCK_SIZE=4096):
+                name = pnr.Compress(quiet=True).Build()
+            self.assertTrue(name.endswith('.tar.' + compression))
+            self.assertTarballHoldsTheData(name, mode)
+            os.remove(self.home + name)
+
+    def test_gzip_members_keep_their_order(self):
+        blocks = [bytes([i]) * 1000 for i in range(50)]
+        out = io.BytesIO()
+        out.close = lambda: None  # keep it readable
+        writer = pnr.BlockWriter(out, gzip.compress, threads=4,
+                                 block_size=1000)
+        for block in blocks:
+            writer.write(block)
+        writer.close()
+        self.assertEqual(gzip.decompress(out.getvalue()), b''.join(blocks))
+
+    def test_failed_blocks_still_close_the_writer(self):
+        out = io.BytesIO()
+        writer = pnr.BlockWriter(out, mock.Mock(side_effect=OSError('boom')),
+                                 threads=4, block_size=1000)
+        writer.write(b'x' * 1500)
+        with self.assertRaises(OSError):
+            writer.close()
+        self.assertTrue(out.closed)
+        with self.assertRaises(RuntimeError):  # the pool is shut down
+            writer.pool.submit(len, b'')
+        writer.close()  # again, as TarFilize does on errors
+
+    def test_failed_compression_leaves_no_tarball(self):
+        with mock.patch.object(pnr.Settings, 'BACKUP_THREADS', 4,
+                               create=True):
+            with mock.patch('gzip.compress', side_effect=OSError('boom')):
+                with self.assertRaises(OSError):
+                    pnr.Compress(quiet=True).Build()
+        self.assertEqual(os.listdir(self.home), ['dir1'])
+
+    def test_zstd_falls_back_to_gzip_if_missing(self):
+        with mock.patch.object(pnr.Settings, 'BACKUP_COMPRESSION', 'zst',
+                               create=True):
+            with mock.patch.dict(sys.modules, {'zstandard': None}):
+                compress = pnr.Compress(quiet=True)
+                name = compress.Build()
+        self.assertTrue(name.endswith('.tar.gz'))
+        self.assertIn('Warning: zstandard is not installed, using gz',
+                      compress.messages)
+        with tarfile.open(self.home + name, 'r:gz') as tar:
+            self.assertEqual(tar.extractfile('dir1/file').read(), b'data')
+
+
+class TestChunkStore(unittest.TestCase):
+    """Test the deduplicated backups."""
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp() + '/'
+        self.addCleanup(shutil.rmtree, self.home)
+        os.mkdir(self.home + 'dir1')
+        self.data = random.Random(0).randbytes(200 * 1024)
+        with open(self.home + 'dir1/file', 'wb') as f:
+            f.write(self.data)
+        self.store = self.Store()
+
+    def Store(self):
+        """Get a store with small chunks (4KB on average)."""
+        store = pnr.ChunkStore(self.home + 'store')
+        store.MIN_SIZE, store.MAX_SIZE, store.MASK = 1024, 16 * 1024, 4095
+        return store
+
+    def Backup(self, name):
+        path = self.home + 'dir1/file'
+        return self.store.Backup(name, [('dir1/file', path)])
+
+    def test_gear_hash_is_a_rolling_hash(self):
+        data = os.urandom(100)
+        value, expected = 0, []
+        result = self.store.Hash(data)
+        for byte in data:
+            value = ((value << 1) + int(self.store.gear[byte])) % 2 ** 32
+            expected.append(value)
+        self.assertEqual(result.tolist(), expected)
+
+    def test_an_insert_only_changes_the_chunks_around(self):
+        before = list(self.store.Chunks(io.BytesIO(self.data)))
+        after = list(self.store.Chunks(io.BytesIO(b'new' + self.data)))
+        self.assertEqual(b''.join(before), self.data)
+        self.assertNotEqual(before[0], after[0])
+        # the min & max sizes may shift the next cut, the rest are the same
+        self.assertLessEqual(set(before[2:]), set(after))
+        self.assertGreater(len(before), 20)
+        for chunk in before[:-1]:
+            self.assertLessEqual(len(chunk), self.store.MAX_SIZE)
+            self.assertGreaterEqual(len(chunk), self.store.MIN_SIZE)
+
+    def test_repeated_backups_write_only_new_chunks(self):
+        chunks, size = self.Backup('1')
+        self.assertEqual(size, len(self.data))
+        with open(self.home + 'dir1/file', 'wb') as f:
+            f.write(self.data + b'tail')
+        chunks, size = self.Backup('2')
+        self.assertEqual(chunks, 1)  # just the last one
+        self.assertLess(size, self.store.MAX_SIZE + 4)
+        # A new object reads the index back
+        self.store = self.Store()
+        self.assertEqual(self.Backup('3'), (0, 0))
+        self.assertEqual(self.store.Snapshots(), ['1', '2', '3'])
+
+    def test_restore_a_snapshot(self):
+        self.Backup('1')
+        with open(self.home + 'dir1/file', 'wb') as f:
+            f.write(b'changed')
+        self.Backup('2')
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        self.assertEqual(self.store.Restore(target, '1'), ['dir1/file'])
+        with open(os.path.join(target, 'dir1/file'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.store.Restore(target)
+        with open(os.path.join(target, 'dir1/file'), 'rb') as f:
+            self.assertEqual(f.read(), b'changed')
+
+    def test_links_are_stored_and_special_files_skipped(self):
+        os.symlink('nowhere', self.home + 'dir1/link')
+        os.mkfifo(self.home + 'dir1/fifo')
+        paths = [('dir1/' + name, self.home + 'dir1/' + name)
+                 for name in ('file', 'link', 'fifo')]
+        self.store.Backup('1', paths)
+        self.assertEqual(sorted(self.store.Snapshot('1')),
+                         ['dir1/file', 'dir1/link'])
+        self.store.Backup('2', paths)
+        self.assertEqual(self.store.Snapshot('2'), self.store.Snapshot('1'))
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        self.store.Restore(target)
+        self.assertEqual(os.readlink(target + '/dir1/link'), 'nowhere')
+        with open(os.path.join(target, 'dir1/file'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_verify_finds_damaged_chunks(self):
+        self.Backup('1')
+        self.assertEqual(self.store.Verify(), [])
+        digest = self.store.Snapshot('1')['dir1/file'][3][0]
+        with open(self.store.ChunkPath(digest), 'wb') as f:
+            f.write(b'garbage')
+        del self.store.index[self.store.Snapshot('1')['dir1/file'][3][-1]]
+        problems = self.store.Verify()
+        self.assertEqual(len(problems), 2)
+        self.assertTrue(problems[0].startswith('chunk ' + digest))
+        self.assertIn('misses 1 chunks', problems[1])
+
+    def test_compress_stores_the_files(self):
+        FakePgDump(self)
+        settings = {'home': self.home, 'BACKUP_FOLDERS': ['dir1'],
+                    'BACKUP_FILES': [], 'PG_BACKUPDB': True,
+                    'PG_DATABASES': ['db'], 'PG_USER': 'u', 'PG_PASS': 'p',
+                    'PG_HOST': 'h',
+                    'BACKUP_FORMAT': 'chunks', 'answers': {'usb': ''},
+                    'batch': False,
+                    'BACKUP_STORE': self.home + 'store'}
+        with mock.patch.multiple(pnr.Settings, create=True, **settings):
+            compress = pnr.Compress(quiet=True)
+            name = compress.Build()
+            self.assertIsNone(name)
+            compress.Finish(name)
+            compress.Discard(name)
+            self.assertFalse(os.path.exists(self.home + '.pnr_dumps'))
+            store = pnr.ChunkStore(self.home + 'store')
+            snapshot = store.Snapshot(store.Snapshots()[0])
+            self.assertEqual(sorted(snapshot), ['db.dump', 'dir1/file'])
+            self.assertEqual(pnr.Command(['verify']).Run(), 0)
+
+
+class TestCommand(unittest.TestCase):
+    """Test the command line & the batch mode."""
+
+    def setUp(self):
+        # Run sets both, so put them back after each test
+        patcher = mock.patch.multiple(pnr.Settings, answers={}, batch=False,
+                                      rebuild=False, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_flags_give_the_answers(self):
+        command = pnr.Command(['all', '--yes', '--no-graph'])
+        self.assertEqual(command.Answers(),
+                         {'graph': '', 'backup': 'k', 'usb': ''})
+        self.assertEqual(pnr.Command(['week']).Answers(), {})
+
+    def test_ask_returns_the_given_answer(self):
+        pnr.Settings.answers = {'graph': 'g'}
+        with mock.patch('builtins.input', side_effect=AssertionError):
+            self.assertEqual(pnr.Ask('Press g to show graph: ', 'graph'), 'g')
+
+    def test_ask_exits_in_batch_mode(self):
+        pnr.Settings.batch = True
+        with mock.patch('builtins.input', side_effect=AssertionError):
+            with self.assertRaises(SystemExit) as exit:
+                pnr.Ask('Press k to backup: ', 'backup')
+        self.assertNotEqual(exit.exception.code, 0)
+
+    def test_missing_path_exits_in_batch_mode(self):
+        pnr.Settings.batch = True
+        with mock.patch.object(pnr.Settings, 'db_file', '/no/such/dir/'):
+            with self.assertRaises(SystemExit):
+                pnr.TrackDB().GetPath()
+
+    def test_restore_takes_a_dir(self):
+        with mock.patch.object(pnr.Compress, 'Restore',
+                               return_value=[]) as restore:
+            self.assertEqual(pnr.Command(['restore', '/tmp/x',
+                                          '--point=b.tar.gz']).Run(), 0)
+        restore.assert_called_once_with('/tmp/x', 'b.tar.gz')
+
+    def test_restore_and_verify_take_options(self):
+        with mock.patch.object(pnr.Compress, 'Restore',
+                               return_value=[]) as restore:
+            self.assertEqual(pnr.Command(['restore', '/tmp/x', '--yes',
+                                          '--batch']).Run(), 0)
+        restore.assert_called_once_with('/tmp/x', None)
+        self.assertTrue(pnr.Settings.batch)
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with mock.patch.multiple(pnr.Settings, create=True, BACKUP_STORE=tmp,
+                                 BACKUP_FORMAT='chunks'):
+            self.assertEqual(pnr.Command(['verify', '--batch']).Run(), 1)
+
+    def test_verify_fails_when_there_is_nothing_to_check(self):
+        with mock.patch.object(pnr.Settings, 'BACKUP_FORMAT', 'tarball',
+                               create=True):
+            with mock.patch('builtins.print') as print_:
+                self.assertEqual(pnr.Command(['verify']).Run(), 1)
+        print_.assert_called_once_with(
+            'Nothing to verify, BACKUP_FORMAT is not chunks')
+
+    def test_menu_on_a_snapshot_makes_no_more_queries(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        settings = {'rollup_file': tmp + '/rollup.db', 'db_snapshot': True,
+                    'BACKUP_BACKGROUND': False, 'batch': True,
+                    'answers': {'graph': '', 'backup': ''}}
+        query = pnr.DataYear.Query
+        with mock.patch.multiple(pnr.Settings, create=True, **settings):
+            with mock.patch.object(pnr.DataYear, 'Query', autospec=True,
+                                   side_effect=query) as patched:
+                with mock.patch('builtins.print'):
+                    pnr.Menu()
+        # those of WorkLog.Load
+        self.assertEqual(patched.call_count, 2)
+
+    def test_reports_dont_load_the_history(self):
+        """The rollup is updated from the db, not from a WorkLog."""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with mock.patch.object(pnr.Settings, 'rollup_file',
+                               tmp + '/rollup.db', create=True):
+            with mock.patch.object(pnr.WorkLog, 'Load',
+                                   side_effect=AssertionError):
+                self.assertEqual(pnr.Command(['week']).Run(), 0)
+                self.assertEqual(pnr.Command(['year']).Run(), 0)
+
+    def test_reports_run_without_asking(self):
+        with mock.patch('builtins.input', side_effect=AssertionError):
+            self.assertEqual(pnr.Command(['last', '--batch']).Run(), 0)
+            self.assertEqual(pnr.Command(['graph', '--no-graph']).Run(), 0)
+            with self.assertRaises(SystemExit):
+                pnr.Command(['graph', '--batch']).Run()
+
+
 # class TestFilters(unittest.TestCase):
 #     """Test the filters for the data extacted."""
 #